@@ -1,17 +1,46 @@
+import argparse
 import asyncio
+import glob
+import hashlib
 import json
 import logging
+import os
 from collections import defaultdict
+from typing import Callable, Iterable, Optional
 
-from coingecko_ids import CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID
+import httpx
+
+from coingecko_ids import CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID, coingecko_ids
 from common import (
     Address,
+    address_cache,
+    address_key,
     ChainId,
     NATIVE_ADDR_0x0,
     NATIVE_ADDR_0xe,
     NATIVE_MATIC_ADDR,
+    normalized_chain_id,
     Token,
-    CHAIN_NAMES_BY_ID,
+)
+from files import CACHE_FOLDER, write_file_atomic
+from http_cache import HttpCache
+from http_client import RATE_LIMITS_PER_HOST, http_client
+from metrics import run_metrics
+from outputs import (
+    ALL_TOKENS_FOLDER,
+    TOKENLISTS_FOLDER,
+    dump_token,
+    index_files,
+    tokenlist_files,
+    wallet_files,
+    write_files,
+)
+from storage import load_all_tokens
+from token_filters import (
+    TokenFilter,
+    filter_tokens,
+    filters_fingerprint,
+    load_ignore_list,
 )
 from token_list_providers import (
     CoinGeckoTokenLists,
@@ -20,82 +49,114 @@ from token_list_providers import (
     RubicLists,
     tokenlists_providers,
 )
+from token_normalizer import token_normalizer
 
-TOKENLISTS_FOLDER = "tokenlists"
-
-ALL_TOKENS_FOLDER = "all_tokens"
+AGGREGATION_STATE_FILE = f"{CACHE_FOLDER}/aggregation_state.json"
 
 log = logging.getLogger(__name__)
 
 
+# providers are tracked as bits of an int while merging, listedIn lists are
+# only built once per token, sorted so the output does not churn
+_PROVIDER_IDS: dict[str, int] = {}
+
+_PROVIDER_NAMES_BY_MASK: dict[int, list[str]] = {}
+
+
+def provider_mask(provider_names: Iterable[str]) -> int:
+    mask = 0
+    for name in provider_names:
+        if name not in _PROVIDER_IDS:
+            _PROVIDER_IDS[name] = len(_PROVIDER_IDS)
+        mask |= 1 << _PROVIDER_IDS[name]
+    return mask
+
+
+def provider_names(mask: int) -> list[str]:
+    if mask not in _PROVIDER_NAMES_BY_MASK:
+        _PROVIDER_NAMES_BY_MASK[mask] = sorted(
+            name for name, i in _PROVIDER_IDS.items() if mask >> i & 1
+        )
+    return list(_PROVIDER_NAMES_BY_MASK[mask])
+
+
 def merge_tokens(
     old_tokens: dict[int, dict[Address, Token]],
     new_tokens: dict[int, dict[Address, Token]],
+    new_listed_in: dict[int, dict[Address, int]],
 ) -> dict[int, dict[Address, Token]]:
-    merged_tokens = {
-        int(k): {a: t for a, t in v.items()} for k, v in old_tokens.items()
-    }
-
+    # merges into old_tokens in place, new_listed_in are provider masks of
+    # new tokens, which already include their listedIn
     for chain_id, tokens in new_tokens.items():
-        if merged_tokens.get(chain_id) is None:
-            merged_tokens[chain_id] = {}
-
-        for _, token in tokens.items():
-            addr = token.address
-            if merged_tokens[chain_id].get(addr) is not None:
-                current_listed_in = merged_tokens[chain_id][addr].listedIn
-                current_listed_in.extend(token.listedIn)
-                merged_tokens[chain_id][addr].listedIn = list(set(current_listed_in))
+        merged_tokens = old_tokens.setdefault(chain_id, {})
+        listed_in = new_listed_in[chain_id]
+
+        for addr, token in tokens.items():
+            current = merged_tokens.get(addr)
+            if current is not None:
+                current.listedIn = provider_names(
+                    listed_in[addr] | provider_mask(current.listedIn)
+                )
             else:
-                merged_tokens[chain_id][addr] = token
+                token.listedIn = provider_names(listed_in[addr])
+                merged_tokens[addr] = token
 
-    return merged_tokens
+    return old_tokens
 
 
 def filter_ignored_tokens(
     tokens: dict[int, dict[Address, Token]],
+    filters: Optional[list[TokenFilter]] = None,
 ) -> dict[int, dict[Address, Token]]:
-    # {chain_id: set(addresses)}
-    IGNORE_LIST = {
-        # bsc scam coins (all addresses have some balance)
-        56: set(
-            [
-                "0x683e9dCf085E5efCc7925858aAcE94D4b8882024",
-                "0xD22202d23fE7dE9E3DbE11a2a88F42f4CB9507cf",
-                "0x5CA42204cDaa70d5c773946e69dE942b85CA6706",
-            ]
-        ),
-        42161: set(["walc.near"]),
-    }
+    if filters is None:
+        filters = [load_ignore_list()]
+    return filter_tokens(tokens, filters)
 
-    filtered = {
-        k: {
-            a: t
-            for a, t in v.items()
-            if k not in IGNORE_LIST or a not in IGNORE_LIST[k]
-        }
-        for k, v in tokens.items()
-    }
 
-    return filtered
+def tokens_fingerprint(tokens: list[Token]) -> str:
+    h = hashlib.sha256()
+    for token_repr in sorted(
+        repr((t.address, t.symbol, t.name, t.decimals, t.logoURI, t.coingeckoId))
+        for t in tokens
+    ):
+        h.update(token_repr.encode())
+    return h.hexdigest()
 
 
-async def collect_trusted_tokens() -> dict[int, list[Token]]:
-    data = await asyncio.gather(
-        *[provider.get_tokenlists() for provider in tokenlists_providers]
-    )
-    provider_data: dict[str, dict[str, list[Token]]] = {}
-    for prov in data:
-        provider_data |= prov
+def code_fingerprint() -> str:
+    # merged chains kept from an earlier run are only valid for the code that
+    # merged them, any change of the scripts merges every chain again
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(f"{os.path.dirname(os.path.abspath(__file__))}/*.py")):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
 
+def load_aggregation_state() -> dict[str, dict]:
+    try:
+        with open(AGGREGATION_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"providers": {}, "chains": {}, "filters": {}, "code": {}}
+
+
+def save_aggregation_state(state: dict[str, dict]) -> None:
+    write_file_atomic(AGGREGATION_STATE_FILE, json.dumps(state, indent=4).encode())
+
+
+def combine_provider_tokens(
+    provider_data: dict[str, dict[ChainId, list[Token]]],
+) -> tuple[dict[int, dict[Address, Token]], dict[int, dict[Address, int]]]:
+    # one token per chain and address key, with provider masks of every token
     res: dict[int, dict[Address, Token]] = defaultdict(dict)
+    listed_in: dict[int, dict[Address, int]] = defaultdict(dict)
     for provider_name, tokens_by_chains in provider_data.items():
+        provider_bit = provider_mask([provider_name])
         for _chain_id, tokens in tokens_by_chains.items():
-            chain_id = int(_chain_id)
-            if chain_id == 101:  # solana
-                chain_id = -1
+            chain_id = normalized_chain_id(int(_chain_id))
             for token in tokens:
-                addr = Address(token.address.lower())
+                addr = address_key(token.address)
                 if token.chainId == 101:
                     token.chainId = ChainId(-1)
                 if addr == NATIVE_ADDR_0xe or addr == NATIVE_MATIC_ADDR:
@@ -118,71 +179,222 @@ async def collect_trusted_tokens() -> dict[int, list[Token]]:
                         "tokens.1inch.io" not in (res[chain_id][addr].logoURI or [])
                     ):
                         res[chain_id][addr].logoURI = token.logoURI
-                    if provider_name not in res[chain_id][addr].listedIn:
-                        res[chain_id][addr].listedIn.append(provider_name)
+                    listed_in[chain_id][addr] |= provider_bit
 
                 else:
                     res[chain_id][addr] = token
-                    res[chain_id][addr].listedIn.append(provider_name)
+                    listed_in[chain_id][addr] = (
+                        provider_mask(token.listedIn) | provider_bit
+                    )
+
+    return res, listed_in
+
+
+def sorted_chain_tokens(
+    tokens: dict[int, dict[Address, Token]],
+) -> dict[int, list[Token]]:
+    return {
+        k: list(sorted(v.values(), key=lambda x: x.address, reverse=True))
+        for k, v in tokens.items()
+        if len(v) > 0
+    }
+
 
-    old_tokens: dict[int, dict[Address, Token]] = {}
-    with open(f"{ALL_TOKENS_FOLDER}/all.json", "r", encoding="utf-8") as f:
-        old_tokens = {
-            int(k): {t.address: t for t in [Token(**t) for t in v]}
-            for k, v in json.load(f).items()
+def trusted_chain_tokens(all_tokens: dict[int, list[Token]]) -> dict[int, list[Token]]:
+    return {k: [t for t in v if len(t.listedIn) > 1] for k, v in all_tokens.items()}
+
+
+def list_files(
+    all_tokens: dict[int, list[Token]], trusted: dict[int, list[Token]]
+) -> dict[str, bytes]:
+    token_texts = {k: [dump_token(t) for t in v] for k, v in all_tokens.items()}
+    trusted_texts = {
+        k: [texts for texts, t in zip(token_texts[k], v) if len(t.listedIn) > 1]
+        for k, v in all_tokens.items()
+    }
+    return (
+        tokenlist_files(TOKENLISTS_FOLDER, trusted_texts)
+        | tokenlist_files(ALL_TOKENS_FOLDER, token_texts)
+        | wallet_files(TOKENLISTS_FOLDER, trusted, trusted_texts)
+        | index_files(TOKENLISTS_FOLDER, trusted)
+        | index_files(ALL_TOKENS_FOLDER, all_tokens)
+    )
+
+
+async def fetch_provider_data(
+    incremental: bool = False,
+    workers: int = 1,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+    http_cache: bool = True,
+    rate_limits: dict[str, tuple[int, int]] = RATE_LIMITS_PER_HOST,
+    chain_filter: Optional[Callable[[int], bool]] = None,
+    fetch: bool = True,
+) -> dict[str, dict[ChainId, list[Token]]]:
+    # chain_filter limits the run to some chains, see shards.py, without
+    # fetch providers only give their tokens stored by earlier runs
+    if not fetch:
+        with run_metrics.stage("providers"):
+            data = [
+                provider.stored_tokenlists(chain_filter)
+                for provider in tokenlists_providers
+            ]
+    else:
+        with run_metrics.stage("providers"), token_normalizer.running(workers):
+            async with http_client(
+                transport, HttpCache() if http_cache else None, rate_limits
+            ) as client:
+                data = await asyncio.gather(
+                    *[
+                        provider.get_tokenlists(client, incremental, chain_filter)
+                        for provider in tokenlists_providers
+                    ]
+                )
+                await coingecko_ids.wait_refresh()
+    provider_data: dict[str, dict[ChainId, list[Token]]] = {}
+    for prov in data:
+        provider_data |= prov
+    run_metrics.provider_tokens = {
+        provider_name: {
+            str(chain_id): len(tokens) for chain_id, tokens in tokens_by_chains.items()
         }
+        for provider_name, tokens_by_chains in provider_data.items()
+    }
+    return provider_data
+
+
+def aggregate_provider_tokens(
+    provider_data: dict[str, dict[ChainId, list[Token]]],
+    old_tokens: dict[int, dict[Address, Token]],
+    changed_chains: Optional[set[int]] = None,
+) -> dict[int, list[Token]]:
+    # merges provider tokens of changed chains, all when None, into the tokens
+    # of the previous run
+    with run_metrics.stage("combine"):
+        res, listed_in = combine_provider_tokens(provider_data)
 
     new_tokens = {
         int(k): {t.address: t for _, t in v.items()}
         for k, v in res.items()
-        if len(v) > 0
+        if len(v) > 0 and (changed_chains is None or int(k) in changed_chains)
+    }
+    new_listed_in = {
+        int(k): {t.address: listed_in[k][addr] for addr, t in res[k].items()}
+        for k in new_tokens
     }
 
-    merged_tokens = merge_tokens(old_tokens, new_tokens)
+    with run_metrics.stage("merge"):
+        merged_tokens = merge_tokens(old_tokens, new_tokens, new_listed_in)
 
-    filtered_tokens = filter_ignored_tokens(merged_tokens)
+    with run_metrics.stage("filter"):
+        filtered_tokens = filter_ignored_tokens(merged_tokens)
 
-    all_tokens = {
-        k: list(sorted(v.values(), key=lambda x: x.address, reverse=True))
-        for k, v in filtered_tokens.items()
-        if len(v) > 0
+    return sorted_chain_tokens(filtered_tokens)
+
+
+async def collect_trusted_tokens(
+    incremental: bool = False,
+    workers: int = 1,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+    http_cache: bool = True,
+    rate_limits: dict[str, tuple[int, int]] = RATE_LIMITS_PER_HOST,
+    fetch: bool = True,
+) -> dict[int, list[Token]]:
+    # transport, http_cache and rate_limits let replay.py run on recorded
+    # responses
+    run_metrics.reset()
+    provider_data = await fetch_provider_data(
+        incremental, workers, transport, http_cache, rate_limits, fetch=fetch
+    )
+
+    # {provider: {chain_id: fingerprint}} of provider tokens before merging
+    fingerprints: dict[str, dict[str, str]] = {
+        provider_name: {
+            str(normalized_chain_id(int(chain_id))): tokens_fingerprint(tokens)
+            for chain_id, tokens in tokens_by_chains.items()
+        }
+        for provider_name, tokens_by_chains in provider_data.items()
+    }
+    chain_providers: dict[str, list[tuple[str, str]]] = defaultdict(list)
+    for provider_name, fingerprint_by_chains in sorted(fingerprints.items()):
+        for chain_key, fingerprint in fingerprint_by_chains.items():
+            chain_providers[chain_key].append((provider_name, fingerprint))
+    chain_fingerprints = {
+        chain_id: hashlib.sha256(json.dumps(providers).encode()).hexdigest()
+        for chain_id, providers in chain_providers.items()
     }
 
-    trusted = {k: [t for t in v if len(t.listedIn) > 1] for k, v in all_tokens.items()}
+    # only chains whose provider data changed since last run are merged and
+    # written again, the rest is already in all_tokens/all.json, a changed
+    # ignore list or code merges every chain again
+    filters = {"fingerprint": filters_fingerprint()}
+    code = {"fingerprint": code_fingerprint()}
+    changed_chains: Optional[set[int]] = None
+    previous_state = load_aggregation_state() if incremental else None
+    if previous_state is not None and previous_state.get("filters") != filters:
+        log.info("Filters changed, all chains are merged again")
+    elif previous_state is not None and previous_state.get("code") != code:
+        log.info("Code changed, all chains are merged again")
+    elif previous_state is not None:
+        previous_chain_fingerprints = previous_state["chains"]
+        changed_chains = {
+            int(chain_id)
+            for chain_id in set(chain_fingerprints) | set(previous_chain_fingerprints)
+            if chain_fingerprints.get(chain_id)
+            != previous_chain_fingerprints.get(chain_id)
+        }
+        log.info(f"Changed chains: {sorted(changed_chains)}")
 
-    # trusted tokens
-    for chain_id, tokens in trusted.items():
-        filename = (
-            f"{TOKENLISTS_FOLDER}/{CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)}.json"
-        )
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump([t.dict() for t in tokens], f, ensure_ascii=False, indent=4)
-    with open(f"{TOKENLISTS_FOLDER}/all.json", "w", encoding="utf-8") as f:
-        json.dump(
-            {k: [t.dict() for t in v] for k, v in trusted.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
+    all_tokens_file = f"{ALL_TOKENS_FOLDER}/all.json"
+    with run_metrics.stage("load_previous"):
+        old_tokens = load_all_tokens(all_tokens_file)
 
-    # all tokens found
-    for chain_id, tokens in all_tokens.items():
-        filename = (
-            f"{ALL_TOKENS_FOLDER}/{CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)}.json"
-        )
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump([t.dict() for t in tokens], f, ensure_ascii=False, indent=4)
-    with open(f"{ALL_TOKENS_FOLDER}/all.json", "w", encoding="utf-8") as f:
-        json.dump(
-            {k: [t.dict() for t in v] for k, v in all_tokens.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
+    all_tokens = aggregate_provider_tokens(provider_data, old_tokens, changed_chains)
 
+    trusted = trusted_chain_tokens(all_tokens)
+    run_metrics.chain_tokens = {
+        str(k): (len(v), len(trusted[k])) for k, v in all_tokens.items()
+    }
+
+    if changed_chains is None or changed_chains:
+        with run_metrics.stage("serialize"):
+            files = list_files(all_tokens, trusted)
+        with run_metrics.stage("write"):
+            write_files(files)
+
+    save_aggregation_state(
+        {
+            "providers": fingerprints,
+            "chains": chain_fingerprints,
+            "filters": filters,
+            "code": code,
+        }
+    )
+
+    log.info(f"Address cache: {address_cache.info()}")
+    run_metrics.save()
     log.info("Succesfully collected trusted tokens")
     return trusted
 
 
 if __name__ == "__main__":
-    asyncio.run(collect_trusted_tokens())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only merge and write chains whose provider data changed since last run",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to validate provider tokens",
+    )
+    parser.add_argument(
+        "--no-fetch",
+        action="store_true",
+        help="rebuild the lists from provider tokens stored by earlier runs, without downloading",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        collect_trusted_tokens(args.incremental, args.workers, fetch=not args.no_fetch)
+    )
@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from typing import Any, Iterator, Optional
+
+from aggregate_tokens import (
+    combine_provider_tokens,
+    filter_ignored_tokens,
+    list_files,
+    merge_tokens,
+    sorted_chain_tokens,
+    trusted_chain_tokens,
+)
+from coingecko_ids import COINS_LIST_URL
+from common import ChainId, Token
+from generate_readme import generate_readme
+from http_client import http_client
+from metrics import run_metrics
+from outputs import write_files
+from replay import Fixtures, prepare_workdir, replay_transport
+from token_list_providers import CoinGeckoOrdinalsTokenLists, tokenlists_providers
+from token_normalizer import token_normalizer
+
+log = logging.getLogger(__name__)
+
+# tokens of every chain at scale 1, close to the size of all_tokens today
+SYNTHETIC_TOKENS_PER_CHAIN = 2000
+
+SYNTHETIC_ORDINALS_PER_SCALE = 20
+
+# a provider lists a token of its chain with this probability
+SYNTHETIC_LISTING_PROBABILITY = 0.6
+
+DEFAULT_SCALES = (1, 10)
+
+DEFAULT_TOLERANCE = 1.25
+
+ORDINALS_COIN_URL = (
+    "https://api.coingecko.com/api/v3/coins/{}?x_cg_api_key=CG-Jw3SbMTpURV2M4CZ2b1pvrRS"
+)
+
+
+def _synthetic_address(chain_id: int, i: int) -> str:
+    if chain_id < 0:  # solana and bitcoin addresses are not hex
+        return f"Tkn{chain_id}x{i:040d}"
+    return f"0x{chain_id:08x}{i:032x}"
+
+
+def _synthetic_token(chain_id: int, i: int) -> dict[str, Any]:
+    return {
+        "symbol": f"T{i}",
+        "name": f"Token {i} of {chain_id}",
+        "address": _synthetic_address(chain_id, i),
+        "decimals": 18,
+        "chainId": chain_id,
+        "logoURI": f"https://example.com/{chain_id}/{i}.png",
+    }
+
+
+def synthetic_fixtures(scale: int, seed: int = 0) -> Fixtures:
+    # responses of every provider url in the shape that provider serves,
+    # providers list random overlapping subsets of every chain
+    rnd = random.Random(seed)
+    tokens_per_chain = SYNTHETIC_TOKENS_PER_CHAIN * scale
+    fixtures = Fixtures()
+
+    def add_json(url: str, body: Any) -> None:
+        fixtures.add(url, 200, "application/json", json.dumps(body).encode())
+
+    for provider in tokenlists_providers:
+        if provider is CoinGeckoOrdinalsTokenLists:
+            continue
+        chain_ids_by_url: dict[str, list[int]] = {}
+        for chain_id, chain_name in provider.chains.items():
+            url = provider.base_url.format(
+                chain_id if provider._by_chain_id else chain_name
+            )
+            chain_ids_by_url.setdefault(url, []).append(int(chain_id))
+        for url, chain_ids in chain_ids_by_url.items():
+            tokens = [
+                _synthetic_token(chain_id, i)
+                for chain_id in chain_ids
+                for i in range(tokens_per_chain)
+                if rnd.random() < SYNTHETIC_LISTING_PROBABILITY
+            ]
+            if provider._tokens_to_list:
+                add_json(url, {t["address"]: t for t in tokens})
+            elif provider._get_chain_id_key:
+                add_json(url, {"tokens": {str(chain_ids[0]): tokens}})
+            else:
+                add_json(url, {"tokens": tokens})
+
+    coins = [
+        {
+            "id": f"coin-{i}",
+            "symbol": f"c{i}",
+            "name": f"Coin {i}",
+            "platforms": {"ethereum": _synthetic_address(1, i)},
+        }
+        for i in range(0, tokens_per_chain, 2)
+    ]
+    ordinals = [
+        {
+            "id": f"ordinal-{i}",
+            "symbol": f"o{i}",
+            "name": f"Ordinal {i}",
+            "platforms": {"ordinals": _synthetic_address(-3, i)},
+        }
+        for i in range(SYNTHETIC_ORDINALS_PER_SCALE * scale)
+    ]
+    add_json(COINS_LIST_URL, coins + ordinals)
+    add_json(CoinGeckoOrdinalsTokenLists.base_url, coins + ordinals)
+    for coin in ordinals:
+        add_json(
+            ORDINALS_COIN_URL.format(coin["id"]),
+            {
+                "platforms": coin["platforms"],
+                "detail_platforms": {"ordinals": {"decimal_place": 0}},
+                "image": {"small": f"https://example.com/{coin['id']}.png"},
+            },
+        )
+    return fixtures
+
+
+class StageTimer:
+    # seconds and peak traced memory of every stage of one run
+
+    def __init__(self, trace_memory: bool) -> None:
+        self.trace_memory = trace_memory
+        self.stages: dict[str, dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        stats = {"seconds": time.perf_counter() - start}
+        if self.trace_memory:
+            stats["peak_mb"] = (
+                tracemalloc.get_traced_memory()[1] - start_memory
+            ) / 2**20
+        self.stages[name] = stats
+        log.info(f"{name}: {stats}")
+
+    def add(self, name: str, seconds: float) -> None:
+        # time measured elsewhere, e.g. summed over concurrent requests
+        self.stages[name] = {"seconds": seconds}
+        log.info(f"{name}: {self.stages[name]}")
+
+
+async def _fetch_and_normalize(
+    fixtures: Fixtures, timer: StageTimer, workers: int
+) -> dict[str, dict[ChainId, list[Token]]]:
+    run_metrics.reset()
+    async with http_client(replay_transport(fixtures), rate_limits={}) as client:
+        # providers parse and validate while they download, so only both
+        # together are timed, fetch and normalize are the seconds run metrics
+        # summed over every url, responses come from memory here
+        with timer.stage("providers"), token_normalizer.running(workers):
+            data = await asyncio.gather(
+                *[provider.get_tokenlists(client) for provider in tokenlists_providers]
+            )
+    providers = run_metrics.providers().values()
+    timer.add(
+        "fetch",
+        sum(
+            p.get("fetch_seconds", 0.0) + p.get("parse_seconds", 0.0) for p in providers
+        ),
+    )
+    timer.add("normalize", sum(p.get("normalize_seconds", 0.0) for p in providers))
+    provider_data: dict[str, dict[ChainId, list[Token]]] = {}
+    for prov in data:
+        provider_data |= prov
+    return provider_data
+
+
+def run_scale(
+    scale: int,
+    trace_memory: bool,
+    repo_dir: str,
+    workdir: Optional[str] = None,
+    workers: int = 1,
+) -> dict[str, Any]:
+    # runs in a fresh process, so module level caches of one scale do not
+    # leak into the next one
+    logging.getLogger().setLevel(logging.WARNING)
+    log.setLevel(logging.INFO)
+    workdir = workdir or tempfile.mkdtemp(prefix="tokenlists-bench-")
+    prepare_workdir(workdir, repo_dir)
+    os.chdir(workdir)
+
+    fixtures = synthetic_fixtures(scale)
+    timer = StageTimer(trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+
+    provider_data = asyncio.run(_fetch_and_normalize(fixtures, timer, workers))
+
+    with timer.stage("combine"):
+        res, listed_in = combine_provider_tokens(provider_data)
+    new_tokens = {k: {t.address: t for t in v.values()} for k, v in res.items() if v}
+    new_listed_in = {
+        k: {t.address: listed_in[k][addr] for addr, t in res[k].items()}
+        for k in new_tokens
+    }
+    # previous run had the same tokens, so every token takes the merge path
+    old_tokens = {
+        k: {addr: Token.trusted(**t.dict()) for addr, t in v.items()}
+        for k, v in new_tokens.items()
+    }
+    with timer.stage("merge_tokens"):
+        merged = merge_tokens(old_tokens, new_tokens, new_listed_in)
+    with timer.stage("filter_ignored_tokens"):
+        filtered = filter_ignored_tokens(merged)
+
+    all_tokens = sorted_chain_tokens(filtered)
+    trusted = trusted_chain_tokens(all_tokens)
+    with timer.stage("serialize"):
+        files = list_files(all_tokens, trusted)
+    with timer.stage("write_files"):
+        write_files(files)
+    with timer.stage("generate_readme"):
+        generate_readme()
+
+    if trace_memory:
+        tracemalloc.stop()
+    return {
+        "scale": scale,
+        "tokens": sum(len(v) for v in all_tokens.values()),
+        "trusted": sum(len(v) for v in trusted.values()),
+        "stages": timer.stages,
+    }
+
+
+def regressions(
+    report: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> list[str]:
+    baseline_by_scale = {run["scale"]: run["stages"] for run in baseline}
+    res = []
+    for run in report:
+        for stage, stats in run["stages"].items():
+            previous = baseline_by_scale.get(run["scale"], {}).get(stage)
+            if previous is None:
+                continue
+            for metric in ("seconds", "peak_mb"):
+                if metric in stats and metric in previous:
+                    if stats[metric] > previous[metric] * tolerance:
+                        res.append(
+                            f"{run['scale']}x {stage} {metric}: "
+                            f"{previous[metric]:.3f} -> {stats[metric]:.3f}"
+                        )
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="time every aggregation stage on synthetic provider responses"
+    )
+    parser.add_argument(
+        "--scales",
+        default=",".join(map(str, DEFAULT_SCALES)),
+        help=f"comma separated multiples of {SYNTHETIC_TOKENS_PER_CHAIN} tokens per chain",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="trace peak memory of every stage, makes every stage several times slower",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to validate provider tokens",
+    )
+    parser.add_argument("--output", help="write the report as json")
+    parser.add_argument("--baseline", help="report of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    report = []
+    for scale in map(int, args.scales.split(",")):
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+            run = pool.submit(
+                run_scale, scale, args.memory, os.getcwd(), workers=args.workers
+            ).result()
+        report.append(run)
+        print(f"{scale}x: {run['tokens']} tokens, {run['trusted']} trusted")
+        for stage, stats in run["stages"].items():
+            print(
+                f"    {stage:<24}" + "  ".join(f"{k}={v:.3f}" for k, v in stats.items())
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"regression: {line}")
+        if slower:
+            sys.exit(1)
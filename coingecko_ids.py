@@ -1,8 +1,22 @@
+import asyncio
+import json
+import logging
+import os
+import time
 from collections import defaultdict
-
-import httpx
+from typing import Optional
 
 from common import Address
+from files import CACHE_FOLDER, write_file_atomic
+from http_client import HttpClient
+
+log = logging.getLogger(__name__)
+
+COINGECKO_IDS_FILE = f"{CACHE_FOLDER}/coingecko_ids.json"
+
+COINGECKO_IDS_TTL_SECONDS = 24 * 60 * 60
+
+COINS_LIST_URL = "https://api.coingecko.com/api/v3/coins/list?include_platform=true"
 
 CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID = {
     1: "ethereum",
@@ -28,7 +42,7 @@ CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID = {
 }
 
 
-def get_coingecko_ids() -> dict[str, dict[Address, str]]:
+def build_coingecko_ids(coins: list[dict]) -> dict[str, dict[Address, str]]:
     chain_id_to_coingecko_platform = {
         "42161": "arbitrum-one",
         "1088": "metis-andromeda",
@@ -48,9 +62,6 @@ def get_coingecko_ids() -> dict[str, dict[Address, str]]:
     coingecko_platform_to_chain_id = {
         v: k for k, v in chain_id_to_coingecko_platform.items()
     }
-    coins = httpx.get(
-        "https://api.coingecko.com/api/v3/coins/list", params={"include_platform": True}
-    ).json()
     res: dict[str, dict[Address, str]] = defaultdict(dict)
     for coin in coins:
         if not coin["id"]:
@@ -63,4 +74,64 @@ def get_coingecko_ids() -> dict[str, dict[Address, str]]:
     return res
 
 
-coingecko_ids = get_coingecko_ids()
+class CoinGeckoIds:
+    # {chain_id: {lowercase address: coingecko id}}, loaded on first lookup
+    # from a local file and refreshed in background once it is older than ttl
+
+    def __init__(
+        self, path: str = COINGECKO_IDS_FILE, ttl: int = COINGECKO_IDS_TTL_SECONDS
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._ids: Optional[dict[str, dict[Address, str]]] = None
+        self._loading: Optional[asyncio.Task] = None
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def load(self, client: HttpClient) -> dict[str, dict[Address, str]]:
+        if self._ids is None:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._load(client))
+            self._ids = await asyncio.shield(self._loading)
+        assert self._ids is not None
+        return self._ids
+
+    async def wait_refresh(self) -> None:
+        if self._refreshing is not None:
+            await self._refreshing
+
+    async def _load(self, client: HttpClient) -> dict[str, dict[Address, str]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                ids = json.load(f)
+            age = time.time() - os.path.getmtime(self.path)
+        except (OSError, ValueError):
+            try:
+                return await self._rebuild(client)
+            except Exception as e:
+                log.error(f"failed to get coingecko ids: {str(e)}")
+                return {}
+
+        if age > self.ttl and self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh(client))
+        return ids
+
+    async def _refresh(self, client: HttpClient) -> None:
+        try:
+            self._ids = await self._rebuild(client)
+        except Exception as e:
+            log.error(f"failed to refresh coingecko ids: {str(e)}")
+
+    async def _rebuild(self, client: HttpClient) -> dict[str, dict[Address, str]]:
+        ids = build_coingecko_ids(await client.get_json(COINS_LIST_URL))
+        try:
+            write_file_atomic(
+                self.path, json.dumps(ids, separators=(",", ":")).encode()
+            )
+        except OSError as e:
+            log.warning(f"coingecko ids not saved: {str(e)}")
+            return ids
+        log.info(f"coingecko ids saved to {self.path}")
+        return ids
+
+
+coingecko_ids = CoinGeckoIds()
@@ -20,6 +20,68 @@ Address = NewType("Address", str)
 ChainId = NewType("ChainId", int)
 
 
+def normalized_chain_id(chain_id: int) -> int:
+    return -1 if chain_id == 101 else chain_id  # solana
+
+
+ADDRESS_CACHE_SIZE = 1 << 18
+
+
+class AddressCache:
+    # the same addresses come from many providers and keccak of the checksum
+    # is costly, so {address: (checksummed address, lowercase key)} is kept
+    # for raw and checksummed forms, the cache is cleared once full
+
+    def __init__(self, maxsize: int = ADDRESS_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: dict[str, tuple[Address, Address]] = {}
+
+    def normalize(self, address: str) -> tuple[Address, Address]:
+        try:
+            res = self._cache[address]
+            self.hits += 1
+            return res
+        except KeyError:
+            self.misses += 1
+
+        v = address.strip()
+        if Web3.is_address(v):
+            if "#" in v:
+                v = v.split("#")[0]
+            v = Web3.to_checksum_address(v)
+        res = (Address(v), Address(v.lower()))
+
+        if len(self._cache) >= self.maxsize:
+            self._cache.clear()
+        self._cache[address] = res
+        self._cache[v] = res
+        return res
+
+    def add(self, address: Address) -> None:
+        # address checksummed elsewhere, e.g. by a normalization worker
+        if address in self._cache:
+            return
+        if len(self._cache) >= self.maxsize:
+            self._cache.clear()
+        self._cache[address] = (address, Address(address.lower()))
+
+    def info(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+address_cache = AddressCache()
+
+
+def checksum_address(address: str) -> Address:
+    return address_cache.normalize(address)[0]
+
+
+def address_key(address: str) -> Address:
+    return address_cache.normalize(address)[1]
+
+
 class Token(BaseModel):
     symbol: str
     name: str
@@ -44,18 +106,47 @@ class Token(BaseModel):
             **data,
         )
 
+    @classmethod
+    def trusted(
+        cls,
+        symbol: str,
+        name: str,
+        address: Address,
+        decimals: int,
+        chainId: ChainId,
+        logoURI: Optional[str] = None,
+        coingeckoId: Optional[str] = None,
+        listedIn: Optional[list[str]] = None,
+    ) -> "Token":
+        # skips validation, only for tokens this pipeline already validated
+        # and wrote itself (all_tokens, caches)
+        token = cls.__new__(cls)
+        object.__setattr__(
+            token,
+            "__dict__",
+            {
+                "symbol": symbol,
+                "name": name,
+                "address": address,
+                "decimals": decimals,
+                "chainId": chainId,
+                "logoURI": logoURI,
+                "coingeckoId": coingeckoId,
+                "listedIn": listedIn if listedIn is not None else [],
+            },
+        )
+        object.__setattr__(token, "__fields_set__", set(_TOKEN_FIELDS))
+        return token
+
     # if logo.startswith('//'):
     # logo = 'ht
 
     @validator("address")
     def addr_checksum(cls, v: str):
-        v = v.strip()
-        if Web3.is_address(v):
-            if "#" in v:
-                v = v.split("#")[0]
-            return Web3.to_checksum_address(v)
-        return v
+        return checksum_address(v)
+
 
+_TOKEN_FIELDS = frozenset(Token.__fields__)
 
 NATIVE_ADDR_0xe = "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee"
 NATIVE_ADDR_0x0 = Address("0x0000000000000000000000000000000000000000")
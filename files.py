@@ -0,0 +1,35 @@
+import os
+import tempfile
+from typing import IO, Optional
+
+CACHE_FOLDER = ".cache"
+
+
+def temp_file(path: str, folder: Optional[str] = None) -> IO[bytes]:
+    # unique name next to path, or in folder when readers list the folder of
+    # path. shard workers share the cache and may write the same file at
+    # once, the last os.replace wins
+    folder = folder or os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    return tempfile.NamedTemporaryFile(
+        dir=folder,
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp",
+        delete=False,
+    )
+
+
+def write_file_atomic(path: str, data: bytes, folder: Optional[str] = None) -> None:
+    # a crash or a concurrent writer never leaves a truncated file behind
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    f = temp_file(path, folder)
+    try:
+        with f:
+            f.write(data)
+        os.replace(f.name, path)
+    except OSError:
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+        raise
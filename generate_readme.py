@@ -21,6 +21,36 @@ or
 
 https://raw.githubusercontent.com/nufi-official/tokenlists/main/tokenlists/bsc.json (Binance Smart Chain Tokenlist)
 
+Every list also has a minified copy in `min/` folder, together with precompressed `.json.gz` and `.json.br` files, like
+
+https://raw.githubusercontent.com/nufi-official/tokenlists/main/tokenlists/min/ethereum.json.gz
+
+For wallets, `tokenlists/slim/` has trusted tokens with only `address`, `decimals`, `symbol` and `chainId`,
+and `tokenlists/top/` has 200 tokens of each chain listed by most providers.
+
+`index/` folders next to the lists map lowercase symbol to addresses, coingeckoId to `[chainId, address]`
+and lowercase address to position of the token in the list (`[chainId, position]` in `index/all.json`).
+
+Python services can query the lists in place with `token_db.TokenDB`, e.g. `TokenDB().get_many([(1, address), ...])`,
+chains are loaded on first use and reloaded when their file changes.
+
+To mirror the lists, `python serve.py --port 8000` serves `/tokenlists/<chain>.json`, `/all_tokens/<chain>.json`
+and `all.json` from memory with gzip/brotli and ETags, filtered with `?addresses=0x..,0x..` or `?trustedOnly=1`.
+It picks up lists written by a new aggregation run by itself.
+
+## Development
+
+`python replay.py record fixtures/` records every provider response of a full run, `python replay.py replay fixtures/`
+runs the aggregation again on them without network. Both run in a temporary folder, so lists of the repo stay untouched.
+
+`python benchmark.py --scales 1,10,100 [--memory] --output report.json` times every stage (fetch, normalize, merge,
+filter, serialization, writing, readme) on synthetic provider lists of current size and 10x/100x,
+`--baseline report.json` fails when a stage got slower than the earlier report.
+
+Every aggregation run writes `.cache/metrics/run.json` and `.cache/metrics/run.prom` (Prometheus text format) with
+durations of every stage, fetch latency, response size, retries and sleeps, parse and normalize time and token counts
+of every provider and chain, and peak memory.
+
 ## Providers
 
 We collect tokenlists from github repos or open APIs from various platforms, currently:
@@ -69,6 +99,19 @@ Install requirements
 Run the script from repo root folder
 ```python3 aggregate_tokens.py```
 
+Pass `--incremental` to merge and rewrite only chains whose provider data changed since the last run
+(state is kept in `.cache`, a change of the code or ignore list merges every chain again).
+Pass `--workers N` to validate provider tokens in `N` processes while the lists download.
+Validated tokens of every provider list are kept in `.cache/last_good` after each successful download. A list that
+fails to download is replaced by its stored tokens for up to 14 days, so its providers keep their `listedIn` credit,
+and the run metrics report how stale they are. `--no-fetch` rebuilds the lists from the stored tokens alone.
+
+Aggregation can also be split into shards of chains:
+```python3 shards.py coordinate --shards 4 --local-workers 4```
+queues one task per shard in `.cache/shards`, runs them in 4 processes, then writes the lists and this readme
+from their outputs. With a `--queue` folder on a shared filesystem, other machines run
+```python3 shards.py work --queue <folder>``` from their own checkout once the shards are queued.
+
 ## Generate readme.md based on aggregated data
 ```bash
 python generate_readme.py
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import marshal
+import os
+from typing import IO, Any, Optional
+
+import httpx
+
+from files import CACHE_FOLDER, temp_file, write_file_atomic
+
+log = logging.getLogger(__name__)
+
+HTTP_CACHE_FOLDER = f"{CACHE_FOLDER}/http"
+
+
+class HttpCache:
+    # {url: (etag, last modified)} next to the parsed body, stored with marshal
+    # because it loads json-like data much faster than json itself
+
+    def __init__(self, folder: str = HTTP_CACHE_FOLDER) -> None:
+        self.folder = folder
+
+    def _path(self, url: str, ext: str) -> str:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.folder, f"{key}.{ext}")
+
+    def _meta(self, url: str) -> dict[str, Optional[str]]:
+        try:
+            with open(self._path(url, "json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def conditional_headers(self, url: str, raw: bool = False) -> dict[str, str]:
+        # raw is for streamed urls, whose body is kept as downloaded
+        meta = self._meta(url)
+        if not meta or not os.path.exists(
+            self._path(url, "body" if raw else "marshal")
+        ):
+            return {}
+        headers = {}
+        if etag := meta.get("etag"):
+            headers["If-None-Match"] = etag
+        if last_modified := meta.get("last_modified"):
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def load(self, url: str) -> Optional[Any]:
+        try:
+            with open(self._path(url, "marshal"), "rb") as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            log.warning(f"http cache for {url} is broken")
+            return None
+
+    def forget(self, url: str) -> None:
+        # without metadata the url is downloaded again, not revalidated
+        try:
+            os.remove(self._path(url, "json"))
+        except OSError:
+            pass
+
+    def fingerprint(self, url: str) -> Optional[str]:
+        return self._meta(url).get("fingerprint")
+
+    def parsed_body_path(self, url: str) -> str:
+        return self._path(url, "marshal")
+
+    def store(
+        self, url: str, resp: httpx.Response, body: Any, fingerprint: str
+    ) -> None:
+        # kept without validators too, as the last good response used when
+        # the url fails
+        try:
+            data = marshal.dumps(body)
+        except ValueError:
+            return
+        try:
+            # body first, so metadata never points to a missing or partial body
+            write_file_atomic(self._path(url, "marshal"), data)
+            self._store_meta(url, resp, fingerprint)
+        except OSError as e:
+            log.warning(f"http cache for {url} not written: {str(e)}")
+
+    def raw_body_path(self, url: str) -> str:
+        return self._path(url, "body")
+
+    def open_raw_writer(self, url: str) -> Optional[IO[bytes]]:
+        # streamed body is written here while it downloads, then stored with
+        # store_raw or dropped with discard_raw, None when it cannot be written
+        try:
+            return temp_file(self.raw_body_path(url))
+        except OSError as e:
+            log.warning(f"http cache for {url} not written: {str(e)}")
+            return None
+
+    def store_raw(
+        self, url: str, resp: httpx.Response, fingerprint: str, writer: IO[bytes]
+    ) -> None:
+        try:
+            os.replace(writer.name, self.raw_body_path(url))
+            self._store_meta(url, resp, fingerprint)
+        except OSError as e:
+            log.warning(f"http cache for {url} not written: {str(e)}")
+            self.discard_raw(writer)
+
+    def discard_raw(self, writer: IO[bytes]) -> None:
+        writer.close()
+        try:
+            os.remove(writer.name)
+        except OSError:
+            pass
+
+    def _store_meta(self, url: str, resp: httpx.Response, fingerprint: str) -> None:
+        meta = {
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "fingerprint": fingerprint,
+        }
+        write_file_atomic(self._path(url, "json"), json.dumps(meta).encode())
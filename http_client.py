@@ -0,0 +1,404 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Callable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from http_cache import HttpCache
+from json_stream import JsonItemScanner, JsonPath
+from metrics import run_metrics
+from retry import RETRYABLE_STATUSES, Retry, RetryError, RetryScheduler
+
+log = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 64
+
+MAX_KEEPALIVE_CONNECTIONS = 32
+
+TIMEOUT_SECONDS = 30.0
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+
+# chunks of not modified bodies read from http cache
+STREAM_CHUNK_SIZE = 1 << 16
+
+# {host: max concurrent requests}, rate limited apis get less
+MAX_CONNECTIONS_PER_HOST = {
+    "api.coingecko.com": 4,
+    "raw.githubusercontent.com": 8,
+    "tokens.coingecko.com": 8,
+}
+
+# rate limited hosts without a usable Retry-After are paused this long
+DEFAULT_RETRY_AFTER_SECONDS = 60.0
+
+# {host: (requests per minute, burst)}
+RATE_LIMITS_PER_HOST = {
+    # coingecko demo api key allows 30 calls per minute
+    "api.coingecko.com": (30, 5),
+}
+
+
+def retry_after_seconds(resp: httpx.Response) -> Optional[float]:
+    # Retry-After is either seconds or an http date, None when absent or invalid
+    value = resp.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, seconds) if math.isfinite(seconds) else None
+
+
+class RateLimiter:
+    # token bucket, paused for Retry-After seconds when the host rate limits us
+
+    def __init__(self, requests_per_minute: int, burst: int) -> None:
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class HttpClient:
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        cache: Optional[HttpCache] = None,
+        rate_limits: dict[str, tuple[int, int]] = RATE_LIMITS_PER_HOST,
+    ) -> None:
+        self.client = client
+        self.cache = cache
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+        self._rate_limiters = {
+            host: RateLimiter(*limit) for host, limit in rate_limits.items()
+        }
+        self._json_by_url: dict[str, asyncio.Task] = {}
+        self.retries = RetryScheduler()
+        # {url: sha256 of the response body}
+        self.fingerprints: dict[str, str] = {}
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(
+                MAX_CONNECTIONS_PER_HOST.get(host, DEFAULT_MAX_CONNECTIONS_PER_HOST)
+            )
+        return self._host_limits[host]
+
+    @asynccontextmanager
+    async def _slot(self, url: str) -> AsyncIterator[float]:
+        # holds a connection of the host and a rate limit token, yields seconds
+        # spent waiting for them
+        rate_limiter = self._rate_limiters.get(urlsplit(url).hostname or "")
+        queued = time.perf_counter()
+        async with self._host_limit(url):
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            yield time.perf_counter() - queued
+
+    def _check_rate_limited(self, url: str, resp: httpx.Response) -> None:
+        rate_limiter = self._rate_limiters.get(urlsplit(url).hostname or "")
+        if rate_limiter is not None and resp.status_code == 429:
+            sleep_time = retry_after_seconds(resp)
+            if sleep_time is None:
+                sleep_time = DEFAULT_RETRY_AFTER_SECONDS
+            log.info(
+                f"{urlsplit(url).hostname} rate limited for {sleep_time:.0f} seconds"
+            )
+            rate_limiter.pause(sleep_time)
+
+    async def _retry_response(self, retry: Retry, resp: httpx.Response) -> None:
+        # rate limited hosts with a limiter already wait for Retry-After there
+        retry_after: Optional[float] = None
+        if resp.status_code != 429 or not self._rate_limiters.get(retry.host):
+            retry_after = retry_after_seconds(resp)
+        await retry.failed(
+            str(resp.status_code),
+            retry_after,
+            resp.status_code in RETRYABLE_STATUSES,
+        )
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        async with self._slot(url) as wait_seconds:
+            start = time.perf_counter()
+            try:
+                resp = await self.client.get(url, **kwargs)
+            except httpx.HTTPError as e:
+                run_metrics.request(
+                    url, type(e).__name__, time.perf_counter() - start, wait_seconds, 0
+                )
+                raise
+        run_metrics.request(
+            url,
+            str(resp.status_code),
+            time.perf_counter() - start,
+            wait_seconds,
+            len(resp.content),
+        )
+        self._check_rate_limited(url, resp)
+        return resp
+
+    async def get_json(self, url: str, deadline: Optional[float] = None) -> Any:
+        # every distinct url is downloaded and parsed once per run, deadline is
+        # the time.monotonic() after which it is not retried
+        if url not in self._json_by_url:
+            self._json_by_url[url] = asyncio.ensure_future(
+                self._fetch_json(url, deadline)
+            )
+        return await asyncio.shield(self._json_by_url[url])
+
+    def _cached_json(self, url: str) -> Optional[Any]:
+        if self.cache is None:
+            return None
+        fingerprint = self.cache.fingerprint(url)
+        if fingerprint is None or not os.path.exists(self.cache.parsed_body_path(url)):
+            return None
+        body = self.cache.load(url)
+        if body is not None:
+            self.fingerprints[url] = fingerprint
+        return body
+
+    async def get_with_retries(
+        self,
+        url: str,
+        deadline: Optional[float] = None,
+        headers: Optional[dict[str, str]] = None,
+    ) -> httpx.Response:
+        # 200 or 304 response, other responses and transport errors are retried
+        # until RetryError
+        retry = self.retries.start(url, deadline)
+        while True:
+            retry.check()
+            try:
+                resp = await self.get(url, headers=headers)
+            except httpx.TransportError as e:
+                await retry.failed(type(e).__name__)
+                continue
+            if resp.status_code in (200, 304):
+                retry.success()
+                return resp
+            await self._retry_response(retry, resp)
+
+    async def _fetch_json(self, url: str, deadline: Optional[float]) -> Any:
+        headers = self.cache.conditional_headers(url) if self.cache else {}
+        try:
+            resp = await self.get_with_retries(url, deadline, headers)
+            if resp.status_code == 304:
+                body = self._cached_json(url)
+                if body is not None:
+                    log.info(f"{url} not modified")
+                    return body
+                # cached body is gone, download it again
+                resp = await self.get_with_retries(url, deadline)
+        except RetryError as e:
+            # last good response is better than none
+            body = self._cached_json(url)
+            if body is None:
+                raise
+            log.warning(f"{str(e)}, using the last cached response")
+            return body
+
+        start = time.perf_counter()
+        try:
+            body = resp.json()
+        except:
+            body = json.loads(resp.text)
+        run_metrics.parsed(url, time.perf_counter() - start)
+        fingerprint = hashlib.sha256(resp.content).hexdigest()
+        self.fingerprints[url] = fingerprint
+        if self.cache:
+            self.cache.store(url, resp, body, fingerprint)
+        return body
+
+    def _has_raw_body(self, url: str) -> bool:
+        return (
+            self.cache is not None
+            and os.path.exists(self.cache.raw_body_path(url))
+            and self.cache.fingerprint(url) is not None
+        )
+
+    @asynccontextmanager
+    async def stream_json(
+        self,
+        url: str,
+        descend: Callable[[JsonPath], bool],
+        deadline: Optional[float] = None,
+    ) -> AsyncIterator["JsonStream"]:
+        # like get_json, but values come out of the body while it downloads,
+        # see JsonItemScanner for descend. Only failures before the body are
+        # retried, later ones are raised to the caller, which may already
+        # have used some values
+        headers = self.cache.conditional_headers(url, raw=True) if self.cache else {}
+        retry = self.retries.start(url, deadline)
+        while True:
+            retry.check()
+            error: Optional[httpx.TransportError] = None
+            async with self._slot(url) as wait_seconds:
+                start = time.perf_counter()
+                resp: Optional[httpx.Response] = None
+                try:
+                    async with self.client.stream("GET", url, headers=headers) as resp:
+                        run_metrics.request(
+                            url,
+                            str(resp.status_code),
+                            time.perf_counter() - start,
+                            wait_seconds,
+                            0,
+                        )
+                        if resp.status_code == 200 or (
+                            resp.status_code == 304 and self._has_raw_body(url)
+                        ):
+                            retry.success()
+                            yield JsonStream(self, url, resp, descend)
+                            return
+                except httpx.HTTPError as e:
+                    if resp is not None:
+                        run_metrics.error(url, type(e).__name__)
+                        raise
+                    run_metrics.request(
+                        url,
+                        type(e).__name__,
+                        time.perf_counter() - start,
+                        wait_seconds,
+                        0,
+                    )
+                    if not isinstance(e, httpx.TransportError):
+                        raise
+                    error = e
+
+            if error is not None:
+                await retry.failed(type(error).__name__)
+                continue
+            assert resp is not None
+            self._check_rate_limited(url, resp)
+            if resp.status_code == 304:
+                # cached body is gone, download it again
+                headers = {}
+                continue
+            await self._retry_response(retry, resp)
+
+
+class JsonStream:
+    # values of one streamed json response, the body is hashed and written to
+    # http cache as it goes, fingerprint is known up front only when the
+    # response is not modified
+
+    def __init__(
+        self,
+        client: HttpClient,
+        url: str,
+        resp: httpx.Response,
+        descend: Callable[[JsonPath], bool],
+    ) -> None:
+        self._client = client
+        self._resp = resp
+        self._scanner = JsonItemScanner(descend)
+        self.url = url
+        self.not_modified = resp.status_code == 304
+        self.fingerprint: Optional[str] = None
+        if self.not_modified and client.cache is not None:
+            self.fingerprint = client.cache.fingerprint(url)
+
+    def _feed(self, chunk: bytes) -> list[tuple[JsonPath, Any]]:
+        start = time.perf_counter()
+        items = self._scanner.feed(chunk)
+        run_metrics.parsed(self.url, time.perf_counter() - start)
+        return items
+
+    async def _chunks(self) -> AsyncIterator[bytes]:
+        cache = self._client.cache
+        if self.not_modified and cache is not None:
+            log.info(f"{self.url} not modified")
+            with open(cache.raw_body_path(self.url), "rb") as f:
+                while chunk := f.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+            return
+
+        h = hashlib.sha256()
+        size = 0
+        writer = None
+        if cache is not None:
+            writer = cache.open_raw_writer(self.url)
+        try:
+            async for chunk in self._resp.aiter_bytes():
+                h.update(chunk)
+                size += len(chunk)
+                if writer is not None and cache is not None:
+                    try:
+                        writer.write(chunk)
+                    except OSError as e:
+                        log.warning(f"http cache for {self.url} not written: {e}")
+                        cache.discard_raw(writer)
+                        writer = None
+                yield chunk
+        except BaseException:
+            # failed or abandoned downloads leave no temp file behind
+            if writer is not None and cache is not None:
+                cache.discard_raw(writer)
+            raise
+        run_metrics.received(self.url, size)
+        self.fingerprint = h.hexdigest()
+        if writer is not None and cache is not None:
+            writer.close()
+            cache.store_raw(self.url, self._resp, self.fingerprint, writer)
+
+    async def __aiter__(self) -> AsyncIterator[tuple[JsonPath, Any]]:
+        async for chunk in self._chunks():
+            for item in self._feed(chunk):
+                yield item
+        for item in self._scanner.close():
+            yield item
+        if self.fingerprint is not None:
+            self._client.fingerprints[self.url] = self.fingerprint
+
+
+@asynccontextmanager
+async def http_client(
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+    cache: Optional[HttpCache] = None,
+    rate_limits: dict[str, tuple[int, int]] = RATE_LIMITS_PER_HOST,
+) -> AsyncIterator[HttpClient]:
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        timeout=TIMEOUT_SECONDS,
+        transport=transport,
+    ) as client:
+        yield HttpClient(client, cache, rate_limits)
@@ -0,0 +1,164 @@
+import codecs
+import json
+from typing import Any, Callable, Optional, Union
+
+JsonPath = tuple[Union[str, int], ...]
+
+_WHITESPACE = " \t\n\r"
+
+_CLOSING = {True: "}", False: "]"}
+
+# characters that may continue a number, or a literal, split between chunks
+_SCALAR_CHARS = frozenset("0123456789.eE+-")
+
+
+class JsonStreamError(ValueError):
+    # the body is not one well formed json document, e.g. an html page or a
+    # truncated download
+    pass
+
+
+class _Frame:
+    # object or array the scanner walked into, state is what comes next:
+    # "first" (key, value or end), "key", "colon", "value" or "next" (comma or end)
+
+    __slots__ = ("is_object", "path", "state", "key", "index")
+
+    def __init__(self, is_object: bool, path: JsonPath) -> None:
+        self.is_object = is_object
+        self.path = path
+        self.state = "first"
+        self.key = ""
+        self.index = 0
+
+
+class JsonItemScanner:
+    # incremental json parser, walks into objects and arrays while
+    # descend(path) is true and parses every other value whole with the C
+    # decoder, returning (path, value) once its text has arrived, so a large
+    # document is never held as text or as one parsed tree
+
+    def __init__(self, descend: Callable[[JsonPath], bool]) -> None:
+        self._descend = descend
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._buf = ""
+        self._pos = 0
+        self._stack: list[_Frame] = []
+        self._done = False
+
+    def feed(self, data: bytes) -> list[tuple[JsonPath, Any]]:
+        self._buf = self._buf[self._pos :] + self._decode_text(data)
+        self._pos = 0
+        return self._scan(eof=False)
+
+    def close(self) -> list[tuple[JsonPath, Any]]:
+        self._buf = self._buf[self._pos :] + self._decode_text(b"", final=True)
+        self._pos = 0
+        items = self._scan(eof=True)
+        if not self._done:
+            raise JsonStreamError("json document is truncated")
+        return items
+
+    def _decode_text(self, data: bytes, final: bool = False) -> str:
+        try:
+            return self._text_decoder.decode(data, final)
+        except UnicodeDecodeError as e:
+            raise JsonStreamError(f"body is not utf-8: {str(e)}") from e
+
+    def _decode(self, pos: int, eof: bool) -> Optional[tuple[Any, int]]:
+        # None while the value may still be incomplete
+        try:
+            value, end = self._decoder.raw_decode(self._buf, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise JsonStreamError(str(e)) from e
+            return None
+        # a number is only complete once a character that cannot continue it
+        # arrived, e.g. 1. or 2e may be 1.5 or 2e3 in the next chunk
+        if (
+            not eof
+            and self._buf[pos] not in '"{['
+            and (end == len(self._buf) or self._buf[end] in _SCALAR_CHARS)
+        ):
+            return None
+        return value, end
+
+    def _close_frame(self) -> None:
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1].state = "next"
+        else:
+            self._done = True
+
+    def _scan(self, eof: bool) -> list[tuple[JsonPath, Any]]:
+        items: list[tuple[JsonPath, Any]] = []
+        buf = self._buf
+        n = len(buf)
+        pos = self._pos
+        while True:
+            while pos < n and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos >= n:
+                break
+            c = buf[pos]
+            if self._done:
+                raise JsonStreamError(f"extra data at {pos}: {c!r}")
+
+            if not self._stack:
+                if c in "{[" and self._descend(()):
+                    self._stack.append(_Frame(c == "{", ()))
+                    pos += 1
+                    continue
+                decoded = self._decode(pos, eof)
+                if decoded is None:
+                    break
+                items.append(((), decoded[0]))
+                pos = decoded[1]
+                self._done = True
+                continue
+
+            frame = self._stack[-1]
+            if frame.state in ("first", "next") and c == _CLOSING[frame.is_object]:
+                self._close_frame()
+                pos += 1
+                continue
+            if frame.state == "next":
+                if c != ",":
+                    raise JsonStreamError(f"expected ',' at {pos}, got {c!r}")
+                frame.state = "key" if frame.is_object else "value"
+                pos += 1
+                continue
+            if frame.is_object and frame.state in ("first", "key"):
+                if c != '"':
+                    raise JsonStreamError(f"expected key at {pos}, got {c!r}")
+                decoded = self._decode(pos, eof)
+                if decoded is None:
+                    break
+                frame.key, pos = decoded
+                frame.state = "colon"
+                continue
+            if frame.state == "colon":
+                if c != ":":
+                    raise JsonStreamError(f"expected ':' at {pos}, got {c!r}")
+                frame.state = "value"
+                pos += 1
+                continue
+
+            step: Union[str, int] = frame.key if frame.is_object else frame.index
+            path = frame.path + (step,)
+            if c in "{[" and self._descend(path):
+                frame.state = "next"
+                frame.index += 1
+                self._stack.append(_Frame(c == "{", path))
+                pos += 1
+                continue
+            decoded = self._decode(pos, eof)
+            if decoded is None:
+                break
+            items.append((path, decoded[0]))
+            pos = decoded[1]
+            frame.state = "next"
+            frame.index += 1
+        self._pos = pos
+        return items
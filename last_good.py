@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import pickle
+import time
+from typing import Optional
+
+from common import Token, address_cache
+from files import CACHE_FOLDER, write_file_atomic
+from token_normalizer import TokenRecord, token_record
+
+log = logging.getLogger(__name__)
+
+LAST_GOOD_FOLDER = f"{CACHE_FOLDER}/last_good"
+
+# stored tokens older than this do not stand in for a failed download, so a
+# provider gone for good drops out of the lists instead of lingering in them
+LAST_GOOD_MAX_AGE_SECONDS = 14 * 24 * 60 * 60
+
+
+class StoredTokens:
+    def __init__(
+        self, fingerprint: Optional[str], records: list[TokenRecord], fetched_at: float
+    ) -> None:
+        self.fingerprint = fingerprint
+        self.records = records
+        self.fetched_at = fetched_at
+
+    @property
+    def age_seconds(self) -> float:
+        return time.time() - self.fetched_at
+
+    def tokens(self) -> list[Token]:
+        res = []
+        for record in self.records:
+            # checksummed when the tokens were validated
+            address_cache.add(record[2])
+            res.append(Token.trusted(*record))
+        return res
+
+
+class LastGoodStore:
+    # validated tokens of the last successful download of every provider url,
+    # one pickle of token records per url, its mtime is when the url was last
+    # fetched or found unchanged
+
+    def __init__(self, folder: str = LAST_GOOD_FOLDER) -> None:
+        self.folder = folder
+
+    def path(self, provider: str, url: str) -> str:
+        key = hashlib.sha256(url.encode()).hexdigest()[:16]
+        return os.path.join(self.folder, f"{provider}-{key}.pickle")
+
+    def exists(self, provider: str, url: str) -> bool:
+        return os.path.exists(self.path(provider, url))
+
+    def load(
+        self,
+        provider: str,
+        url: str,
+        fingerprint: Optional[str] = None,
+        max_age: Optional[float] = None,
+    ) -> Optional[StoredTokens]:
+        # any stored tokens when fingerprint is None, however old when max_age
+        # is None
+        path = self.path(provider, url)
+        try:
+            fetched_at = os.path.getmtime(path)
+            with open(path, "rb") as f:
+                stored_fingerprint, records = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        if fingerprint is not None and stored_fingerprint != fingerprint:
+            return None
+        if max_age is not None and time.time() - fetched_at > max_age:
+            return None
+        return StoredTokens(stored_fingerprint, records, fetched_at)
+
+    def save(
+        self,
+        provider: str,
+        url: str,
+        tokens: list[Token],
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        data = pickle.dumps(
+            (fingerprint, [token_record(t) for t in tokens]), pickle.HIGHEST_PROTOCOL
+        )
+        try:
+            write_file_atomic(self.path(provider, url), data)
+        except OSError as e:
+            log.warning(f"tokens of {url} not stored: {str(e)}")
+
+    def touch(self, provider: str, url: str) -> None:
+        # an unchanged response confirms the stored tokens
+        try:
+            os.utime(self.path(provider, url))
+        except OSError:
+            pass
+
+
+last_good_store = LastGoodStore()
@@ -0,0 +1,294 @@
+import json
+import logging
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from files import CACHE_FOLDER, write_file_atomic
+
+log = logging.getLogger(__name__)
+
+METRICS_FOLDER = f"{CACHE_FOLDER}/metrics"
+
+METRICS_JSON_FILE = f"{METRICS_FOLDER}/run.json"
+
+METRICS_PROMETHEUS_FILE = f"{METRICS_FOLDER}/run.prom"
+
+PROMETHEUS_PREFIX = "tokenlists"
+
+
+class UrlMetrics:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.wait_seconds = 0.0
+        self.sleep_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.bytes = 0
+        self.statuses: dict[str, int] = defaultdict(int)
+        self.provider: Optional[str] = None
+        self.chain_ids: list[str] = []
+        self.normalize_seconds = 0.0
+        self.tokens = 0
+        # age of stored tokens used instead of a fresh download
+        self.stale_seconds: Optional[float] = None
+
+
+class RunMetrics:
+    # everything measured during one aggregation run, fed by the http client,
+    # providers and aggregate_tokens, written as json and prometheus text
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.urls: dict[str, UrlMetrics] = defaultdict(UrlMetrics)
+        # {provider: {chain_id: tokens}}
+        self.provider_tokens: dict[str, dict[str, int]] = {}
+        # {chain_id: (tokens, trusted tokens)}
+        self.chain_tokens: dict[str, tuple[int, int]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def request(
+        self, url: str, status: str, seconds: float, wait_seconds: float, size: int
+    ) -> None:
+        # status is the http status code or the name of the raised exception
+        m = self.urls[url]
+        m.requests += 1
+        m.seconds += seconds
+        m.wait_seconds += wait_seconds
+        m.bytes += size
+        m.statuses[status] += 1
+
+    def received(self, url: str, size: int) -> None:
+        # body size of streamed responses, known once they are read
+        self.urls[url].bytes += size
+
+    def error(self, url: str, status: str) -> None:
+        self.urls[url].statuses[status] += 1
+
+    def retry(self, url: str, sleep_seconds: float) -> None:
+        m = self.urls[url]
+        m.retries += 1
+        m.sleep_seconds += sleep_seconds
+
+    def parsed(self, url: str, seconds: float) -> None:
+        self.urls[url].parse_seconds += seconds
+
+    def url_provider(self, url: str, provider: str, chain_ids: list[str]) -> None:
+        m = self.urls[url]
+        m.provider = provider
+        m.chain_ids = chain_ids
+
+    def normalized(self, url: str, tokens: int, seconds: float) -> None:
+        m = self.urls[url]
+        m.tokens += tokens
+        m.normalize_seconds += seconds
+
+    def stale(self, url: str, age_seconds: float) -> None:
+        self.urls[url].stale_seconds = age_seconds
+
+    @staticmethod
+    def peak_memory_bytes() -> int:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def providers(self) -> dict[str, dict[str, Any]]:
+        res: dict[str, dict[str, Any]] = {}
+        for m in self.urls.values():
+            if m.provider is None:
+                continue
+            p = res.setdefault(
+                m.provider,
+                {
+                    "urls": 0,
+                    "requests": 0,
+                    "retries": 0,
+                    "fetch_seconds": 0.0,
+                    "wait_seconds": 0.0,
+                    "sleep_seconds": 0.0,
+                    "parse_seconds": 0.0,
+                    "normalize_seconds": 0.0,
+                    "bytes": 0,
+                    "errors": 0,
+                    "stale_chains": {},
+                },
+            )
+            p["urls"] += 1
+            p["requests"] += m.requests
+            p["retries"] += m.retries
+            p["fetch_seconds"] += m.seconds
+            p["wait_seconds"] += m.wait_seconds
+            p["sleep_seconds"] += m.sleep_seconds
+            p["parse_seconds"] += m.parse_seconds
+            p["normalize_seconds"] += m.normalize_seconds
+            p["bytes"] += m.bytes
+            p["errors"] += sum(
+                n
+                for status, n in m.statuses.items()
+                if not status.startswith(("2", "3"))
+            )
+            if m.stale_seconds is not None:
+                for chain_id in m.chain_ids:
+                    p["stale_chains"][chain_id] = m.stale_seconds
+        for provider, tokens_by_chain in self.provider_tokens.items():
+            p = res.setdefault(provider, {})
+            p["tokens"] = sum(tokens_by_chain.values())
+            p["chains"] = tokens_by_chain
+        return res
+
+    def report(self) -> dict[str, Any]:
+        return {
+            "started_at": self.started_at,
+            "duration_seconds": time.perf_counter() - self._started,
+            "peak_memory_bytes": self.peak_memory_bytes(),
+            "stages": self.stages,
+            "providers": self.providers(),
+            "chains": {
+                chain_id: {"tokens": tokens, "trusted": trusted}
+                for chain_id, (tokens, trusted) in self.chain_tokens.items()
+            },
+            "urls": {
+                url: {
+                    "provider": m.provider,
+                    "chain_ids": m.chain_ids,
+                    "requests": m.requests,
+                    "retries": m.retries,
+                    "fetch_seconds": m.seconds,
+                    "wait_seconds": m.wait_seconds,
+                    "sleep_seconds": m.sleep_seconds,
+                    "parse_seconds": m.parse_seconds,
+                    "normalize_seconds": m.normalize_seconds,
+                    "bytes": m.bytes,
+                    "tokens": m.tokens,
+                    "stale_seconds": m.stale_seconds,
+                    "statuses": dict(m.statuses),
+                }
+                for url, m in self.urls.items()
+            },
+        }
+
+    def prometheus(self, report: Optional[dict[str, Any]] = None) -> str:
+        report = report or self.report()
+        lines = []
+
+        def metric(name: str, kind: str, samples: list[tuple[dict, float]]) -> None:
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{k}="{str(v)}"' for k, v in sorted(labels.items())
+                )
+                lines.append(
+                    f"{name}{{{label_text}}} {value}"
+                    if label_text
+                    else f"{name} {value}"
+                )
+
+        metric("run_duration_seconds", "gauge", [({}, report["duration_seconds"])])
+        metric("run_started_at_seconds", "gauge", [({}, report["started_at"])])
+        metric("peak_memory_bytes", "gauge", [({}, report["peak_memory_bytes"])])
+        metric(
+            "stage_seconds",
+            "gauge",
+            [({"stage": k}, v) for k, v in report["stages"].items()],
+        )
+        providers = report["providers"]
+        for field, kind in (
+            ("requests", "counter"),
+            ("retries", "counter"),
+            ("errors", "counter"),
+            ("fetch_seconds", "gauge"),
+            ("wait_seconds", "gauge"),
+            ("sleep_seconds", "gauge"),
+            ("parse_seconds", "gauge"),
+            ("normalize_seconds", "gauge"),
+            ("bytes", "counter"),
+        ):
+            name = (
+                "provider_response_bytes" if field == "bytes" else f"provider_{field}"
+            )
+            metric(
+                f"{name}_total" if kind == "counter" else name,
+                kind,
+                [
+                    ({"provider": p}, v[field])
+                    for p, v in providers.items()
+                    if field in v
+                ],
+            )
+        metric(
+            "provider_tokens",
+            "gauge",
+            [
+                ({"provider": p, "chain_id": chain_id}, tokens)
+                for p, v in providers.items()
+                for chain_id, tokens in v.get("chains", {}).items()
+            ],
+        )
+        metric(
+            "provider_stale_seconds",
+            "gauge",
+            [
+                ({"provider": p, "chain_id": chain_id}, age)
+                for p, v in providers.items()
+                for chain_id, age in v.get("stale_chains", {}).items()
+            ],
+        )
+        metric(
+            "chain_tokens",
+            "gauge",
+            [({"chain_id": k}, v["tokens"]) for k, v in report["chains"].items()],
+        )
+        metric(
+            "chain_trusted_tokens",
+            "gauge",
+            [({"chain_id": k}, v["trusted"]) for k, v in report["chains"].items()],
+        )
+        return "\n".join(lines) + "\n"
+
+    def save(
+        self,
+        json_path: str = METRICS_JSON_FILE,
+        prometheus_path: str = METRICS_PROMETHEUS_FILE,
+    ) -> dict[str, Any]:
+        report = self.report()
+        for path, text in (
+            (json_path, json.dumps(report, indent=4)),
+            (prometheus_path, self.prometheus(report)),
+        ):
+            write_file_atomic(path, text.encode())
+
+        slowest = sorted(
+            report["providers"].items(),
+            key=lambda item: -item[1].get("fetch_seconds", 0.0),
+        )[:3]
+        log.info(
+            f"Run took {report['duration_seconds']:.1f}s, peak memory "
+            f"{report['peak_memory_bytes'] // 2**20}MB, slowest providers: "
+            + ", ".join(f"{p} {v.get('fetch_seconds', 0.0):.1f}s" for p, v in slowest)
+        )
+        stale = [p for p, v in report["providers"].items() if v.get("stale_chains")]
+        if stale:
+            log.warning(f"Stale tokens of {', '.join(sorted(stale))} were used")
+        return report
+
+
+run_metrics = RunMetrics()
@@ -0,0 +1,255 @@
+import gzip
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from common import CHAIN_NAMES_BY_ID, Token, address_key
+from files import write_file_atomic
+
+try:
+    import brotli  # type: ignore[import]
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+TOKENLISTS_FOLDER = "tokenlists"
+
+ALL_TOKENS_FOLDER = "all_tokens"
+
+WRITE_WORKERS = 8
+
+# minified and precompressed copies of every list, e.g. tokenlists/min/bsc.json.gz
+MIN_FOLDER = "min"
+
+# lighter lists for wallets, only fields needed for balance lookup
+SLIM_FOLDER = "slim"
+
+SLIM_FIELDS = ("address", "decimals", "symbol", "chainId")
+
+# most listed tokens of every chain
+TOP_FOLDER = "top"
+
+TOP_TOKENS_COUNT = 200
+
+# lookup indexes next to the lists, {"symbol": {lowercase symbol: [address]},
+# "coingeckoId": {id: [[chainId, address]]}, "address": {lowercase address: position}}
+INDEX_FOLDER = "index"
+
+COMPRESSED_FOLDERS = (MIN_FOLDER, SLIM_FOLDER, TOP_FOLDER, INDEX_FOLDER)
+
+BROTLI_QUALITY = 9
+
+# every token is serialized once with indent=4, lists and all.json are then
+# put together from these texts, so output matches json.dump(..., indent=4)
+_INDENT = "    "
+
+
+def dump_token(token: Token) -> tuple[str, str]:
+    # (indented, minified)
+    data = token.dict()
+    return (
+        json.dumps(data, ensure_ascii=False, indent=4),
+        json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+    )
+
+
+def _indent(text: str) -> str:
+    # json never contains raw newlines inside strings
+    return text.replace("\n", f"\n{_INDENT}")
+
+
+def dump_list(token_texts: list[str]) -> str:
+    if not token_texts:
+        return "[]"
+    return f"[\n{_INDENT}" + f",\n{_INDENT}".join(map(_indent, token_texts)) + "\n]"
+
+
+def dump_chains(chain_texts: dict[int, str]) -> str:
+    if not chain_texts:
+        return "{}"
+    return (
+        "{\n"
+        + ",\n".join(
+            f'{_INDENT}"{chain_id}": {_indent(text)}'
+            for chain_id, text in chain_texts.items()
+        )
+        + "\n}"
+    )
+
+
+def dump_min_list(token_texts: list[str]) -> str:
+    return "[" + ",".join(token_texts) + "]"
+
+
+def dump_min_chains(chain_texts: dict[int, str]) -> str:
+    return (
+        "{"
+        + ",".join(f'"{chain_id}":{text}' for chain_id, text in chain_texts.items())
+        + "}"
+    )
+
+
+def chain_filename(folder: str, chain_id: int) -> str:
+    return f"{folder}/{CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)}.json"
+
+
+def tokenlist_files(
+    folder: str, token_texts: dict[int, list[tuple[str, str]]]
+) -> dict[str, bytes]:
+    chain_texts = {
+        chain_id: dump_list([text for text, _ in texts])
+        for chain_id, texts in token_texts.items()
+    }
+    files = {
+        chain_filename(folder, chain_id): text.encode()
+        for chain_id, text in chain_texts.items()
+    }
+    files[f"{folder}/all.json"] = dump_chains(chain_texts).encode()
+
+    min_folder = f"{folder}/{MIN_FOLDER}"
+    min_chain_texts = {
+        chain_id: dump_min_list([text for _, text in texts])
+        for chain_id, texts in token_texts.items()
+    }
+    files |= {
+        chain_filename(min_folder, chain_id): text.encode()
+        for chain_id, text in min_chain_texts.items()
+    }
+    files[f"{min_folder}/all.json"] = dump_min_chains(min_chain_texts).encode()
+    return files
+
+
+def dump_slim_token(token: Token) -> str:
+    return json.dumps(
+        {field: getattr(token, field) for field in SLIM_FIELDS},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def top_tokens_rank(token: Token) -> tuple[int, bool, str]:
+    return (-len(token.listedIn), token.coingeckoId is None, token.address)
+
+
+def wallet_files(
+    folder: str,
+    tokens: dict[int, list[Token]],
+    token_texts: dict[int, list[tuple[str, str]]],
+) -> dict[str, bytes]:
+    files = {}
+    for chain_id, chain_tokens in tokens.items():
+        files[chain_filename(f"{folder}/{SLIM_FOLDER}", chain_id)] = dump_min_list(
+            [dump_slim_token(t) for t in chain_tokens]
+        ).encode()
+
+        min_texts = {
+            t.address: text for t, (_, text) in zip(chain_tokens, token_texts[chain_id])
+        }
+        top = sorted(chain_tokens, key=top_tokens_rank)[:TOP_TOKENS_COUNT]
+        files[chain_filename(f"{folder}/{TOP_FOLDER}", chain_id)] = dump_min_list(
+            [min_texts[t.address] for t in top]
+        ).encode()
+    return files
+
+
+def chain_index(tokens: list[Token]) -> dict[str, dict]:
+    by_symbol: dict[str, list[str]] = {}
+    by_coingecko_id: dict[str, list[tuple[int, str]]] = {}
+    by_address: dict[str, int] = {}
+    for position, t in enumerate(tokens):
+        by_symbol.setdefault(t.symbol.lower(), []).append(t.address)
+        if t.coingeckoId:
+            by_coingecko_id.setdefault(t.coingeckoId, []).append((t.chainId, t.address))
+        by_address.setdefault(address_key(t.address), position)
+    return {"symbol": by_symbol, "coingeckoId": by_coingecko_id, "address": by_address}
+
+
+def all_chains_index(tokens: dict[int, list[Token]]) -> dict[str, dict]:
+    # addresses and symbols are not unique across chains, so everything
+    # points to [chainId, address] or [chainId, position]
+    by_symbol: dict[str, list[tuple[int, str]]] = {}
+    by_coingecko_id: dict[str, list[tuple[int, str]]] = {}
+    by_address: dict[str, list[tuple[int, int]]] = {}
+    for chain_id, chain_tokens in tokens.items():
+        index = chain_index(chain_tokens)
+        for symbol, addresses in index["symbol"].items():
+            by_symbol.setdefault(symbol, []).extend((chain_id, a) for a in addresses)
+        for coingecko_id, entries in index["coingeckoId"].items():
+            by_coingecko_id.setdefault(coingecko_id, []).extend(entries)
+        for address, position in index["address"].items():
+            by_address.setdefault(address, []).append((chain_id, position))
+    return {"symbol": by_symbol, "coingeckoId": by_coingecko_id, "address": by_address}
+
+
+def _dump_index(index: dict[str, dict]) -> bytes:
+    return json.dumps(index, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def index_files(folder: str, tokens: dict[int, list[Token]]) -> dict[str, bytes]:
+    index_folder = f"{folder}/{INDEX_FOLDER}"
+    files = {
+        chain_filename(index_folder, chain_id): _dump_index(chain_index(chain_tokens))
+        for chain_id, chain_tokens in tokens.items()
+    }
+    files[f"{index_folder}/all.json"] = _dump_index(all_chains_index(tokens))
+    return files
+
+
+def is_compressed_file(path: str) -> bool:
+    return os.path.basename(os.path.dirname(path)) in COMPRESSED_FOLDERS
+
+
+def compress(path: str, data: bytes) -> dict[str, bytes]:
+    files = {f"{path}.gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        files[f"{path}.br"] = brotli.compress(data, quality=BROTLI_QUALITY)
+    return files
+
+
+def write_file(path: str, data: bytes) -> bool:
+    # unchanged files are not touched, others are replaced atomically so
+    # a crash never leaves a truncated file behind
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+
+    write_file_atomic(path, data)
+    return True
+
+
+def write_files(files: dict[str, bytes]) -> list[str]:
+    with ThreadPoolExecutor(WRITE_WORKERS) as pool:
+        written = list(pool.map(write_file, files.keys(), files.values()))
+        changed = [path for path, was_written in zip(files, written) if was_written]
+
+        # minified files are compressed only when they changed
+        to_compress = [
+            path
+            for path in files
+            if is_compressed_file(path)
+            and (
+                path in changed
+                or not os.path.exists(f"{path}.gz")
+                or (brotli is not None and not os.path.exists(f"{path}.br"))
+            )
+        ]
+        compressed: dict[str, bytes] = {}
+        for variants in pool.map(
+            compress, to_compress, [files[path] for path in to_compress]
+        ):
+            compressed |= variants
+        written = list(pool.map(write_file, compressed.keys(), compressed.values()))
+        changed += [
+            path for path, was_written in zip(compressed, written) if was_written
+        ]
+
+    if brotli is None:
+        log.warning("brotli is not installed, .br files are not updated")
+    log.info(f"Written {len(changed)} files")
+    return changed
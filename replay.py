@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+import httpx
+
+from aggregate_tokens import collect_trusted_tokens
+from outputs import ALL_TOKENS_FOLDER, TOKENLISTS_FOLDER
+from token_filters import IGNORE_LIST_FILE
+
+log = logging.getLogger(__name__)
+
+FIXTURES_INDEX_FILE = "index.json"
+
+# copied into the working directory of a recorded or replayed run, so the
+# lists of the repo are never overwritten
+WORKDIR_FILES = ("logger.yml", IGNORE_LIST_FILE)
+
+WORKDIR_FOLDERS = (TOKENLISTS_FOLDER, ALL_TOKENS_FOLDER)
+
+
+class Fixtures:
+    # recorded responses, {url: (status, content type, body)}, stored as
+    # index.json next to a gzipped body per url
+
+    def __init__(self) -> None:
+        self.responses: dict[str, tuple[int, str, bytes]] = {}
+
+    def add(self, url: str, status: int, content_type: str, body: bytes) -> None:
+        self.responses[url] = (status, content_type, body)
+
+    def get(self, url: str) -> Optional[tuple[int, str, bytes]]:
+        return self.responses.get(url)
+
+    @staticmethod
+    def _body_filename(url: str) -> str:
+        return f"{hashlib.sha256(url.encode()).hexdigest()}.gz"
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        index = {}
+        for url, (status, content_type, body) in sorted(self.responses.items()):
+            filename = self._body_filename(url)
+            with open(os.path.join(folder, filename), "wb") as f:
+                f.write(gzip.compress(body, mtime=0))
+            index[url] = {
+                "status": status,
+                "content_type": content_type,
+                "body": filename,
+            }
+        with open(os.path.join(folder, FIXTURES_INDEX_FILE), "w") as f:
+            json.dump(index, f, indent=4)
+
+    @classmethod
+    def load(cls, folder: str) -> "Fixtures":
+        fixtures = cls()
+        with open(os.path.join(folder, FIXTURES_INDEX_FILE), "r") as f:
+            index = json.load(f)
+        for url, entry in index.items():
+            with open(os.path.join(folder, entry["body"]), "rb") as f:
+                body = gzip.decompress(f.read())
+            fixtures.add(url, entry["status"], entry["content_type"], body)
+        return fixtures
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    # passes requests to the real upstreams and keeps successful responses
+
+    def __init__(self, fixtures: Fixtures) -> None:
+        self.fixtures = fixtures
+        self._transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        resp = await self._transport.handle_async_request(request)
+        body = await resp.aread()
+        await resp.aclose()
+        # body is already decoded, so content encoding headers are dropped
+        content_type = resp.headers.get("Content-Type", "application/json")
+        if resp.status_code == 200:
+            self.fixtures.add(str(request.url), 200, content_type, body)
+        headers = {"Content-Type": content_type}
+        if "Retry-After" in resp.headers:
+            headers["Retry-After"] = resp.headers["Retry-After"]
+        return httpx.Response(resp.status_code, headers=headers, content=body)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def replay_transport(fixtures: Fixtures) -> httpx.MockTransport:
+    # urls without a fixture get 404, which is not retried
+    def handler(request: httpx.Request) -> httpx.Response:
+        fixture = fixtures.get(str(request.url))
+        if fixture is None:
+            log.warning(f"no fixture for {request.url}")
+            return httpx.Response(404)
+        status, content_type, body = fixture
+        return httpx.Response(
+            status, headers={"Content-Type": content_type}, content=body
+        )
+
+    return httpx.MockTransport(handler)
+
+
+def prepare_workdir(workdir: str, repo_dir: str = ".") -> None:
+    os.makedirs(workdir, exist_ok=True)
+    for filename in WORKDIR_FILES:
+        shutil.copy(os.path.join(repo_dir, filename), workdir)
+    for folder in WORKDIR_FOLDERS:
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+        for filename in os.listdir(os.path.join(repo_dir, folder)):
+            path = os.path.join(repo_dir, folder, filename)
+            if filename.endswith(".json") and os.path.isfile(path):
+                shutil.copy(path, os.path.join(workdir, folder))
+
+
+async def record(fixtures_folder: str) -> None:
+    # http cache is off, so every url is downloaded in full and recorded
+    fixtures = Fixtures()
+    await collect_trusted_tokens(
+        transport=RecordingTransport(fixtures), http_cache=False
+    )
+    fixtures.save(fixtures_folder)
+    log.info(f"Recorded {len(fixtures.responses)} responses to {fixtures_folder}")
+
+
+async def replay(fixtures_folder: str) -> dict[int, int]:
+    fixtures = Fixtures.load(fixtures_folder)
+    trusted = await collect_trusted_tokens(
+        transport=replay_transport(fixtures), http_cache=False, rate_limits={}
+    )
+    return {chain_id: len(tokens) for chain_id, tokens in trusted.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="record provider responses once and replay them offline"
+    )
+    parser.add_argument("mode", choices=("record", "replay"))
+    parser.add_argument("fixtures", help="folder of recorded responses")
+    parser.add_argument(
+        "--workdir",
+        help="where the run writes its lists and cache, a temporary folder by default",
+    )
+    args = parser.parse_args()
+
+    fixtures_folder = os.path.abspath(args.fixtures)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tokenlists-")
+    prepare_workdir(workdir)
+    os.chdir(workdir)
+    log.info(f"Working in {workdir}")
+    if args.mode == "record":
+        asyncio.run(record(fixtures_folder))
+    else:
+        counts = asyncio.run(replay(fixtures_folder))
+        log.info(f"Trusted tokens by chain: {counts}")
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from metrics import run_metrics
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 6
+
+BACKOFF_BASE_SECONDS = 1.0
+
+BACKOFF_MAX_SECONDS = 60.0
+
+# responses worth another attempt, anything else fails right away
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# requests of a host giving up in a row before its other requests fail fast,
+# single failed attempts do not count, concurrent requests to a briefly
+# failing host would open it at once
+BREAKER_FAILURES = 3
+
+# seconds an open breaker waits before letting one request through again
+BREAKER_COOLDOWN_SECONDS = 60.0
+
+
+class RetryError(Exception):
+    pass
+
+
+class CircuitOpenError(RetryError):
+    pass
+
+
+class CircuitBreaker:
+    # closed while a host answers, open after BREAKER_FAILURES failed requests
+    # in a row, then half open: one attempt per cooldown decides whether it
+    # closes
+
+    def __init__(
+        self,
+        failures: int = BREAKER_FAILURES,
+        cooldown: float = BREAKER_COOLDOWN_SECONDS,
+    ) -> None:
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        self.opened_at = now
+        return True
+
+    def success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def failure(self) -> bool:
+        # True when this failure opened the breaker
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failures:
+            opened = self.opened_at is None
+            self.opened_at = time.monotonic()
+            return opened
+        return False
+
+
+class Retry:
+    # attempts of one request, see RetryScheduler
+
+    def __init__(
+        self,
+        scheduler: "RetryScheduler",
+        url: str,
+        deadline: Optional[float],
+    ) -> None:
+        self._scheduler = scheduler
+        self.url = url
+        self.host = urlsplit(url).hostname or ""
+        self.deadline = deadline
+        self.attempts = 0
+        self._breaker = scheduler.breaker(self.host)
+
+    def check(self) -> None:
+        # before every attempt
+        if not self._breaker.allow():
+            run_metrics.error(self.url, "CircuitOpen")
+            raise CircuitOpenError(f"{self.host} keeps failing, {self.url} skipped")
+
+    def success(self) -> None:
+        self._breaker.success()
+
+    def _give_up(self) -> None:
+        if self._breaker.failure():
+            log.warning(f"{self.host} keeps failing, circuit opened")
+
+    async def failed(
+        self, reason: str, retry_after: Optional[float] = None, retryable: bool = True
+    ) -> None:
+        # sleeps before the next attempt or raises RetryError when there is none
+        self.attempts += 1
+        if not retryable:
+            raise RetryError(f"{self.url} failed: {reason}")
+        if self.attempts >= self._scheduler.max_attempts:
+            self._give_up()
+            raise RetryError(
+                f"{self.url} failed after {self.attempts} attempts: {reason}"
+            )
+        delay = self._scheduler.delay(self.attempts, retry_after)
+        if self.deadline is not None and time.monotonic() + delay > self.deadline:
+            self._give_up()
+            raise RetryError(f"{self.url} failed before its deadline: {reason}")
+        run_metrics.retry(self.url, delay)
+        log.info(f"{self.url} {reason}, retrying in {delay:.1f} seconds")
+        await asyncio.sleep(delay)
+
+
+class RetryScheduler:
+    # exponential backoff with full jitter, so requests failing together do
+    # not retry together, and a circuit breaker per host, shared by every
+    # request of a run
+
+    def __init__(
+        self,
+        max_attempts: int = MAX_ATTEMPTS,
+        base: float = BACKOFF_BASE_SECONDS,
+        cap: float = BACKOFF_MAX_SECONDS,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker()
+        return self._breakers[host]
+
+    def delay(self, attempts: int, retry_after: Optional[float] = None) -> float:
+        # Retry-After is honored as given, not capped like the backoff, a
+        # request gives up instead when it would pass its deadline
+        backoff = random.uniform(0, min(self.cap, self.base * 2 ** (attempts - 1)))
+        return max(backoff, retry_after or 0.0)
+
+    def start(self, url: str, deadline: Optional[float] = None) -> Retry:
+        # deadline is time.monotonic() after which no attempt is started
+        return Retry(self, url, deadline)
@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import logging.config
+import os
+from typing import Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import yaml
+
+from common import Token, address_key
+from outputs import ALL_TOKENS_FOLDER, MIN_FOLDER, TOKENLISTS_FOLDER, compress
+from storage import json_loads
+from token_db import TokenDB, chain_id_from_filename
+
+log = logging.getLogger(__name__)
+
+SERVED_FOLDERS = (TOKENLISTS_FOLDER, ALL_TOKENS_FOLDER)
+
+RELOAD_INTERVAL_SECONDS = 10
+
+# filtered responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+MAX_HEADER_LINES = 100
+
+_ENCODING_EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+_REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+class Resource:
+    # minified body with its precompressed variants, {encoding: bytes}
+
+    def __init__(self, body: bytes, variants: dict[str, bytes]) -> None:
+        self.variants = {"identity": body} | variants
+        self.etag = hashlib.sha256(body).hexdigest()
+
+    def negotiate(self, accept_encoding: str) -> tuple[str, bytes, str]:
+        # (encoding, body, strong etag of that encoding)
+        accepted = {e.split(";")[0].strip() for e in accept_encoding.split(",")}
+        for encoding in _ENCODING_EXTENSIONS:
+            if encoding in accepted and encoding in self.variants:
+                return encoding, self.variants[encoding], f'"{self.etag}-{encoding}"'
+        return "identity", self.variants["identity"], f'"{self.etag}"'
+
+
+def _read(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def load_resource(folder: str, filename: str) -> Optional[Resource]:
+    # min/ copies and their .gz/.br files are used as written by the last
+    # run, missing ones are made from the indented list
+    min_path = f"{folder}/{MIN_FOLDER}/{filename}"
+    body = _read(min_path)
+    variants = {}
+    if body is not None:
+        for encoding, ext in _ENCODING_EXTENSIONS.items():
+            data = _read(f"{min_path}{ext}")
+            if data is not None:
+                variants[encoding] = data
+    else:
+        data = _read(f"{folder}/{filename}")
+        if data is None:
+            return None
+        body = _dump(json_loads(data))
+    if len(variants) < len(_ENCODING_EXTENSIONS):
+        compressed = compress(min_path, body)
+        for encoding, ext in _ENCODING_EXTENSIONS.items():
+            data = compressed.get(f"{min_path}{ext}")
+            if data is not None:
+                variants.setdefault(encoding, data)
+    return Resource(body, variants)
+
+
+def _dump(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _filtered_resource(data) -> Resource:
+    body = _dump(data)
+    if len(body) < MIN_COMPRESS_SIZE:
+        return Resource(body, {})
+    return Resource(body, {"gzip": gzip.compress(body, mtime=0)})
+
+
+def _is_trusted(token: Token) -> bool:
+    return len(token.listedIn) > 1
+
+
+class TokenListServer:
+    # serves /tokenlists/<chain>.json, /all_tokens/<chain>.json and their
+    # all.json from memory, whole lists are reloaded once a run rewrites them
+
+    def __init__(self, folders: tuple[str, ...] = SERVED_FOLDERS) -> None:
+        self.folders = folders
+        self.dbs = {folder: TokenDB(folder) for folder in folders}
+        self._resources: dict[str, Resource] = {}
+        self._stamps: dict[str, Optional[tuple[float, int]]] = {}
+
+    def _stamp(self, folder: str) -> Optional[tuple[float, int]]:
+        # (latest mtime, file count) of the lists, cheap enough to poll
+        try:
+            paths = [
+                os.path.join(folder, f)
+                for f in os.listdir(folder)
+                if f.endswith(".json")
+            ]
+            return max((os.stat(p).st_mtime for p in paths), default=0.0), len(paths)
+        except OSError:
+            return None
+
+    def reload(self, force: bool = False) -> bool:
+        changed = [
+            folder
+            for folder in self.folders
+            if force or self._stamp(folder) != self._stamps.get(folder)
+        ]
+        if not changed:
+            return False
+        resources = dict(self._resources)
+        for folder in changed:
+            self._stamps[folder] = self._stamp(folder)
+            for key in [k for k in resources if k.startswith(f"/{folder}/")]:
+                del resources[key]
+            if not os.path.isdir(folder):
+                continue
+            for filename in sorted(os.listdir(folder)):
+                if filename != "all.json" and chain_id_from_filename(filename) is None:
+                    continue
+                resource = load_resource(folder, filename)
+                if resource is not None:
+                    resources[f"/{folder}/{filename}"] = resource
+        self._resources = resources
+        log.info(f"Loaded {len(resources)} lists from {', '.join(changed)}")
+        return True
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                log.warning(f"reload failed: {str(e)}")
+
+    def resolve(self, target: str) -> tuple[int, Optional[Resource]]:
+        url = urlsplit(target)
+        path = unquote(url.path)
+        query = parse_qs(url.query)
+        folder, _, filename = path.strip("/").partition("/")
+        if folder not in self.folders or "/" in filename:
+            return 404, None
+
+        addresses: Optional[list[str]] = None
+        if "addresses" in query:
+            addresses = sorted(
+                {
+                    address_key(a)
+                    for value in query["addresses"]
+                    for a in value.split(",")
+                    if a.strip()
+                }
+            )
+        trusted_only = query.get("trustedOnly", ["0"])[-1] in ("1", "true")
+        if addresses is None and trusted_only and folder == ALL_TOKENS_FOLDER:
+            # trusted tokens of all_tokens are exactly tokenlists
+            if TOKENLISTS_FOLDER in self.folders:
+                folder, trusted_only = TOKENLISTS_FOLDER, False
+
+        if addresses is None and not trusted_only:
+            resource = self._resources.get(f"/{folder}/{filename}")
+            return (200, resource) if resource is not None else (404, None)
+
+        db = self.dbs[folder]
+        if filename == "all.json":
+            chain_ids = db.chain_ids()
+        else:
+            chain_id = chain_id_from_filename(filename)
+            if chain_id is None or f"/{folder}/{filename}" not in self._resources:
+                return 404, None
+            chain_ids = [chain_id]
+
+        data: dict[str, list[dict]] = {}
+        for chain_id in chain_ids:
+            if addresses is not None:
+                found = db.get_many((chain_id, a) for a in addresses)
+                tokens = [t for t in found if t is not None]
+            else:
+                tokens = db.tokens(chain_id)
+            if trusted_only:
+                tokens = [t for t in tokens if _is_trusted(t)]
+            data[str(chain_id)] = [t.dict() for t in tokens]
+
+        if filename != "all.json":
+            return 200, _filtered_resource(data[str(chain_ids[0])])
+        return 200, _filtered_resource({k: v for k, v in data.items() if v})
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        method, target, version = request_line.decode("latin-1").split()
+        headers: dict[str, str] = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = (
+            headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        )
+
+        if method not in ("GET", "HEAD"):
+            status, resource = 405, None
+        else:
+            try:
+                # filtered lists are built from the token db, which may load
+                # every chain file, so they are resolved off the event loop
+                if urlsplit(target).query:
+                    status, resource = await asyncio.to_thread(self.resolve, target)
+                else:
+                    status, resource = self.resolve(target)
+            except Exception as e:
+                log.warning(f"{target} failed: {str(e)}")
+                status, resource = 400, None
+
+        response_headers = {"Connection": "keep-alive" if keep_alive else "close"}
+        body = b""
+        if resource is not None:
+            encoding, body, etag = resource.negotiate(
+                headers.get("accept-encoding", "")
+            )
+            response_headers |= {
+                "Content-Type": "application/json",
+                "ETag": etag,
+                "Vary": "Accept-Encoding",
+                "Cache-Control": "public, max-age=60",
+            }
+            if encoding != "identity":
+                response_headers["Content-Encoding"] = encoding
+            if etag in {e.strip() for e in headers.get("if-none-match", "").split(",")}:
+                status, body = 304, b""
+        response_headers["Content-Length"] = str(len(body))
+
+        head = f"HTTP/1.1 {status} {_REASONS[status]}\r\n" + "".join(
+            f"{k}: {v}\r\n" for k, v in response_headers.items()
+        )
+        writer.write(head.encode("latin-1") + b"\r\n")
+        if method != "HEAD":
+            writer.write(body)
+        await writer.drain()
+        return keep_alive
+
+
+async def serve(
+    host: str, port: int, reload_interval: float = RELOAD_INTERVAL_SECONDS
+) -> None:
+    server = TokenListServer()
+    server.reload(force=True)
+    watcher = asyncio.ensure_future(server.watch(reload_interval))
+    try:
+        async with await asyncio.start_server(server.handle, host, port) as srv:
+            log.info(f"Serving {', '.join(server.folders)} on http://{host}:{port}")
+            await srv.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+if __name__ == "__main__":
+    with open("./logger.yml", "r") as stream:
+        logging.config.dictConfig(yaml.load(stream, Loader=yaml.FullLoader))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=RELOAD_INTERVAL_SECONDS,
+        help="seconds between checks for lists written by a new run",
+    )
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.reload_interval))
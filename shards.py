@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Optional
+
+from aggregate_tokens import (
+    aggregate_provider_tokens,
+    fetch_provider_data,
+    list_files,
+    trusted_chain_tokens,
+)
+from common import Token
+from generate_readme import generate_readme
+from files import CACHE_FOLDER, write_file_atomic
+from metrics import METRICS_FOLDER, run_metrics
+from outputs import ALL_TOKENS_FOLDER, write_files
+from storage import iter_chain_chunks, json_loads, load_all_tokens
+
+log = logging.getLogger(__name__)
+
+# work queue shared by the coordinator and the shard workers, workers on other
+# machines point --queue at the same folder on a shared filesystem
+QUEUE_FOLDER = f"{CACHE_FOLDER}/shards"
+
+QUEUE_STATES = ("pending", "running", "done", "failed")
+
+SHARD_OUTPUT_FOLDER = "output"
+
+POLL_INTERVAL_SECONDS = 2
+
+DEFAULT_TIMEOUT_SECONDS = 2 * 60 * 60
+
+ALL_TOKENS_FILE = f"{ALL_TOKENS_FOLDER}/all.json"
+
+
+def shard_of(chain_id: int, shards: int) -> int:
+    # stable across processes and machines, unlike hash()
+    return zlib.crc32(str(chain_id).encode()) % shards
+
+
+class WorkQueue:
+    # every task is a json file moved between state folders, os.rename is
+    # atomic, so each pending task is claimed by exactly one worker
+
+    def __init__(self, folder: str = QUEUE_FOLDER) -> None:
+        self.folder = folder
+
+    def _path(self, state: str, name: str = "") -> str:
+        return os.path.join(self.folder, state, name)
+
+    def reset(self) -> None:
+        for state in QUEUE_STATES + (SHARD_OUTPUT_FOLDER,):
+            shutil.rmtree(self._path(state), ignore_errors=True)
+            os.makedirs(self._path(state))
+
+    def _write(self, state: str, name: str, task: dict[str, Any]) -> None:
+        # written next to the state folders first, so a task is never seen
+        # half written
+        write_file_atomic(
+            self._path(state, name), json.dumps(task, indent=4).encode(), self.folder
+        )
+
+    def put(self, name: str, task: dict[str, Any]) -> None:
+        self._write("pending", name, task)
+
+    def claim(self) -> Optional[tuple[str, dict[str, Any]]]:
+        try:
+            names = sorted(os.listdir(self._path("pending")))
+        except FileNotFoundError:
+            return None
+        for name in names:
+            try:
+                os.rename(self._path("pending", name), self._path("running", name))
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            with open(self._path("running", name), "r", encoding="utf-8") as f:
+                return name, json.load(f)
+        return None
+
+    def finish(self, name: str, state: str, info: dict[str, Any]) -> None:
+        with open(self._path("running", name), "r", encoding="utf-8") as f:
+            task = json.load(f)
+        self._write(state, name, task | info)
+        os.remove(self._path("running", name))
+
+    def count(self, state: str) -> int:
+        return len(os.listdir(self._path(state)))
+
+    def tasks(self, state: str) -> dict[str, dict[str, Any]]:
+        res = {}
+        for name in sorted(os.listdir(self._path(state))):
+            with open(self._path(state, name), "r", encoding="utf-8") as f:
+                res[name] = json.load(f)
+        return res
+
+    def output_path(self, name: str) -> str:
+        return self._path(SHARD_OUTPUT_FOLDER, name)
+
+
+def save_shard_output(path: str, tokens: dict[int, list[Token]]) -> None:
+    data = json.dumps(
+        {str(k): [t.dict() for t in v] for k, v in tokens.items()},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    write_file_atomic(path, data.encode())
+
+
+def load_shard_output(path: str) -> dict[int, list[Token]]:
+    with open(path, "rb") as f:
+        data = json_loads(f.read())
+    return {int(k): [Token.trusted(**t) for t in v] for k, v in data.items()}
+
+
+async def run_shard(
+    shard: int, shards: int, output_path: str, workers: int = 1
+) -> dict[int, list[Token]]:
+    # fetches, merges and filters only chains of this shard, lists shared by
+    # several chains are downloaded by every shard
+    def in_shard(chain_id: int) -> bool:
+        return shard_of(chain_id, shards) == shard
+
+    run_metrics.reset()
+    provider_data = await fetch_provider_data(workers=workers, chain_filter=in_shard)
+    with run_metrics.stage("load_previous"):
+        old_tokens = load_all_tokens(ALL_TOKENS_FILE, chain_filter=in_shard)
+
+    all_tokens = aggregate_provider_tokens(provider_data, old_tokens)
+    with run_metrics.stage("write"):
+        save_shard_output(output_path, all_tokens)
+
+    trusted = trusted_chain_tokens(all_tokens)
+    run_metrics.chain_tokens = {
+        str(k): (len(v), len(trusted[k])) for k, v in all_tokens.items()
+    }
+    name = os.path.basename(output_path)
+    run_metrics.save(f"{METRICS_FOLDER}/{name}.json", f"{METRICS_FOLDER}/{name}.prom")
+    return all_tokens
+
+
+def work(queue_folder: str = QUEUE_FOLDER, workers: int = 1) -> int:
+    # runs pending shards until the queue is empty, returns how many ran
+    queue = WorkQueue(queue_folder)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    done = 0
+    while (task := queue.claim()) is not None:
+        name, spec = task
+        log.info(f"{worker} runs {name}")
+        start = time.perf_counter()
+        try:
+            all_tokens = asyncio.run(
+                run_shard(
+                    spec["shard"], spec["shards"], queue.output_path(name), workers
+                )
+            )
+        except Exception as e:
+            log.exception(f"{name} failed")
+            queue.finish(name, "failed", {"worker": worker, "error": str(e)})
+            continue
+        queue.finish(
+            name,
+            "done",
+            {
+                "worker": worker,
+                "seconds": time.perf_counter() - start,
+                "chains": sorted(all_tokens),
+            },
+        )
+        done += 1
+    return done
+
+
+def _previous_chain_order() -> list[int]:
+    # chains keep their place in all.json, so a sharded run does not reorder it
+    if not os.path.exists(ALL_TOKENS_FILE):
+        return []
+    return [chain_id for chain_id, _ in iter_chain_chunks(ALL_TOKENS_FILE)]
+
+
+def wait_for_shards(
+    queue: WorkQueue,
+    shards: int,
+    local_workers: list[Future],
+    timeout: float,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        failed = queue.tasks("failed")
+        if failed:
+            errors = ", ".join(f"{k}: {v.get('error')}" for k, v in failed.items())
+            raise RuntimeError(f"shards failed: {errors}")
+        if queue.count("done") == shards:
+            return
+        for future in local_workers:
+            if future.done() and future.exception() is not None:
+                raise RuntimeError(f"shard worker crashed: {future.exception()}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"shards not done after {timeout} seconds")
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def coordinate(
+    shards: int,
+    local_workers: int = 0,
+    queue_folder: str = QUEUE_FOLDER,
+    workers: int = 1,
+    timeout: float = DEFAULT_TIMEOUT_SECONDS,
+) -> dict[int, list[Token]]:
+    # queues one task per shard, waits for local or remote workers to run
+    # them, then writes the lists and readme from all shard outputs
+    run_metrics.reset()
+    queue = WorkQueue(queue_folder)
+    queue.reset()
+    names = [f"shard-{shard}-of-{shards}" for shard in range(shards)]
+    for shard, name in enumerate(names):
+        queue.put(name, {"shard": shard, "shards": shards})
+    log.info(f"Queued {shards} shards in {queue_folder}")
+
+    with run_metrics.stage("shards"):
+        if local_workers > 0:
+            # spawned, so every worker starts without the coordinator's state
+            with ProcessPoolExecutor(
+                local_workers, mp_context=get_context("spawn")
+            ) as pool:
+                futures = [
+                    pool.submit(work, queue_folder, workers)
+                    for _ in range(local_workers)
+                ]
+                wait_for_shards(queue, shards, futures, timeout)
+        else:
+            wait_for_shards(queue, shards, [], timeout)
+
+    with run_metrics.stage("combine_shards"):
+        shard_tokens: dict[int, list[Token]] = {}
+        for name in names:
+            shard_tokens |= load_shard_output(queue.output_path(name))
+        order = {chain_id: i for i, chain_id in enumerate(_previous_chain_order())}
+        all_tokens = {
+            chain_id: shard_tokens[chain_id]
+            for chain_id in sorted(
+                shard_tokens, key=lambda chain_id: order.get(chain_id, len(order))
+            )
+        }
+
+    trusted = trusted_chain_tokens(all_tokens)
+    run_metrics.chain_tokens = {
+        str(k): (len(v), len(trusted[k])) for k, v in all_tokens.items()
+    }
+    with run_metrics.stage("serialize"):
+        files = list_files(all_tokens, trusted)
+    with run_metrics.stage("write"):
+        write_files(files)
+    generate_readme()
+
+    for name, task in queue.tasks("done").items():
+        log.info(f"{name} on {task['worker']} took {task['seconds']:.1f}s")
+    run_metrics.save()
+    return trusted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="aggregate tokens in shards of chains, run by local or remote workers"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    coordinate_parser = subparsers.add_parser(
+        "coordinate", help="queue shards, wait for them and write the lists"
+    )
+    coordinate_parser.add_argument("--shards", type=int, required=True)
+    coordinate_parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        help="shard workers started by the coordinator, 0 waits for remote workers",
+    )
+    coordinate_parser.add_argument(
+        "--timeout", type=float, default=DEFAULT_TIMEOUT_SECONDS
+    )
+    work_parser = subparsers.add_parser(
+        "work", help="run queued shards until the queue is empty"
+    )
+    for subparser in (coordinate_parser, work_parser):
+        subparser.add_argument("--queue", default=QUEUE_FOLDER)
+        subparser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of processes every shard uses to validate provider tokens",
+        )
+    args = parser.parse_args()
+
+    if args.command == "coordinate":
+        coordinate(
+            args.shards, args.local_workers, args.queue, args.workers, args.timeout
+        )
+    else:
+        log.info(f"Ran {work(args.queue, args.workers)} shards")
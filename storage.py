@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+import re
+from typing import Any, Callable, Iterator, Optional, Union
+
+from common import Address, Token
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+# all.json is written with indent=4, so every chain starts on its own line
+_CHAIN_START = re.compile(rb'^    "(-?\d+)": \[\s*$')
+_EMPTY_CHAIN = re.compile(rb'^    "(-?\d+)": \[\],?\s*$')
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def iter_chain_chunks(path: str) -> Iterator[tuple[int, Union[bytes, list[dict]]]]:
+    # yields raw json array of every chain, so only one chain is held as text;
+    # files in other layouts are parsed whole
+    with open(path, "rb") as f:
+        chain_id = None
+        lines: list[bytes] = []
+        for line in f:
+            if chain_id is not None:
+                if line.startswith(b"    ]"):
+                    lines.append(b"]")
+                    yield chain_id, b"".join(lines)
+                    chain_id = None
+                    lines = []
+                else:
+                    lines.append(line)
+            elif m := _CHAIN_START.match(line):
+                chain_id = int(m[1])
+                lines = [b"["]
+            elif m := _EMPTY_CHAIN.match(line):
+                yield int(m[1]), []
+            elif line.strip() not in (b"{", b"}", b""):
+                break
+        else:
+            if chain_id is None:
+                return
+
+    log.info(f"{path} is not indented, parsing it at once")
+    with open(path, "rb") as f:
+        for k, v in json_loads(f.read()).items():
+            yield int(k), v
+
+
+def build_chain_tokens(chunk: Union[bytes, list[dict]]) -> dict[Address, Token]:
+    raw_tokens = json_loads(chunk) if isinstance(chunk, bytes) else chunk
+    return {t.address: t for t in [Token.trusted(**t) for t in raw_tokens]}
+
+
+def load_all_tokens(
+    path: str, chain_filter: Optional[Callable[[int], bool]] = None
+) -> dict[int, dict[Address, Token]]:
+    # chains left out by chain_filter are skipped as text, never parsed. Loaded
+    # in this process, building tokens costs more than parsing, so sending
+    # them back from worker processes only made it slower
+    if not os.path.exists(path):
+        log.warning(f"{path} not found, starting with no tokens")
+        return {}
+
+    return {
+        chain_id: build_chain_tokens(chunk)
+        for chain_id, chunk in iter_chain_chunks(path)
+        if chain_filter is None or chain_filter(chain_id)
+    }
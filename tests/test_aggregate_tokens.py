@@ -0,0 +1,38 @@
+from aggregate_tokens import combine_provider_tokens, merge_tokens
+from common import Address, ChainId, Token
+
+
+def _token(i: int, listed_in: list[str]) -> Token:
+    return Token.trusted(
+        symbol=f"T{i}",
+        name=f"Token {i}",
+        address=Address(f"0x{i:040x}"),
+        decimals=18,
+        chainId=ChainId(56),
+        listedIn=listed_in,
+    )
+
+
+def test_merge_tokens_joins_listed_in_of_every_provider():
+    old_tokens = {
+        56: {
+            t.address: t
+            for t in (_token(1, ["uniswap", "1inch"]), _token(2, ["pancake"]))
+        }
+    }
+    provider_data = {
+        # listedIn served by a provider is kept next to its own name
+        "coingecko_ordinals": {ChainId(56): [_token(3, ["coingecko"])]},
+        "pancake": {ChainId(56): [_token(1, []), _token(3, [])]},
+        "1inch": {ChainId(56): [_token(4, [])]},
+    }
+    new_tokens, listed_in = combine_provider_tokens(provider_data)
+    merged = merge_tokens(old_tokens, new_tokens, listed_in)
+
+    assert merged is old_tokens
+    assert {t.symbol: t.listedIn for t in merged[56].values()} == {
+        "T1": ["1inch", "pancake", "uniswap"],
+        "T2": ["pancake"],
+        "T3": ["coingecko", "coingecko_ordinals", "pancake"],
+        "T4": ["1inch"],
+    }
@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+import httpx
+
+from http_cache import HttpCache
+from http_client import http_client
+
+URL = "https://tokens.example.org/list.json"
+
+BODY = b'{"tokens": [{"symbol": "T1"}, {"symbol": "T2"}]}'
+
+
+class EtagServer:
+    # serves BODY with an etag, 304 when the request has it
+
+    def __init__(self) -> None:
+        self.requests: list[tuple[str, int]] = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        etag = '"v1"'
+        if request.headers.get("If-None-Match") == etag:
+            self.requests.append((etag, 304))
+            return httpx.Response(304, headers={"ETag": etag})
+        self.requests.append(("", 200))
+        return httpx.Response(
+            200,
+            headers={"ETag": etag, "Content-Type": "application/json"},
+            content=BODY,
+        )
+
+    async def get_json(self, cache: HttpCache):
+        transport = httpx.MockTransport(self.handler)
+        async with http_client(transport, cache, rate_limits={}) as client:
+            return await client.get_json(URL), client.fingerprints.get(URL)
+
+    async def stream_symbols(self, cache: HttpCache) -> list[str]:
+        transport = httpx.MockTransport(self.handler)
+        async with http_client(transport, cache, rate_limits={}) as client:
+            async with client.stream_json(URL, lambda path: len(path) < 2) as stream:
+                return [
+                    value["symbol"]
+                    async for path, value in stream
+                    if path[:1] == ("tokens",)
+                ]
+
+
+def test_not_modified_response_uses_cached_body(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = EtagServer()
+    cache = HttpCache()
+    body, fingerprint = asyncio.run(server.get_json(cache))
+    assert asyncio.run(server.get_json(cache)) == (body, fingerprint)
+    assert body["tokens"][1] == {"symbol": "T2"}
+    assert fingerprint is not None
+    assert server.requests == [("", 200), ('"v1"', 304)]
+
+
+def test_not_modified_stream_uses_cached_body(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = EtagServer()
+    cache = HttpCache()
+    assert asyncio.run(server.stream_symbols(cache)) == ["T1", "T2"]
+    assert asyncio.run(server.stream_symbols(cache)) == ["T1", "T2"]
+    assert server.requests == [("", 200), ('"v1"', 304)]
+
+
+def test_forgotten_url_is_downloaded_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = EtagServer()
+    cache = HttpCache()
+    asyncio.run(server.get_json(cache))
+    cache.forget(URL)
+    assert cache.fingerprint(URL) is None
+    assert cache.conditional_headers(URL) == {}
+    body, fingerprint = asyncio.run(server.get_json(cache))
+    assert body["tokens"][0] == {"symbol": "T1"}
+    assert server.requests == [("", 200), ("", 200)]
+    assert cache.fingerprint(URL) == fingerprint
+
+
+def test_missing_cached_body_is_downloaded_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = EtagServer()
+    cache = HttpCache()
+    asyncio.run(server.get_json(cache))
+    os.remove(cache.parsed_body_path(URL))
+    assert asyncio.run(server.get_json(cache))[0]["tokens"][0] == {"symbol": "T1"}
+    assert server.requests == [("", 200), ("", 200)]
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from json_stream import JsonItemScanner, JsonStreamError
+
+# a real list, wrapped the way providers serve it, with numbers of every shape
+with open("all_tokens/1135.json", "rb") as f:
+    TOKENS = json.loads(f.read())
+
+DOCUMENT = json.dumps(
+    {
+        "name": "Lisk",
+        "version": {"major": 1, "minor": 20},
+        "tokens": TOKENS,
+        "total": 1.5,
+        "scale": -2.5e-3,
+        "ok": True,
+    },
+    indent=2,
+).encode()
+
+
+def scan(chunks: list[bytes]) -> dict:
+    scanner = JsonItemScanner(lambda path: len(path) < 1 or path == ("tokens",))
+    items = []
+    for chunk in chunks:
+        items += scanner.feed(chunk)
+    items += scanner.close()
+    res: dict = {}
+    for path, value in items:
+        if path[0] == "tokens":
+            res.setdefault("tokens", []).append(value)
+        else:
+            res[path[0]] = value
+    return res
+
+
+def test_split_at_every_offset():
+    expected = json.loads(DOCUMENT)
+    for i in range(len(DOCUMENT) + 1):
+        assert scan([DOCUMENT[:i], DOCUMENT[i:]]) == expected, i
+
+
+@pytest.mark.parametrize(
+    "chunks, expected",
+    [
+        ([b'{"tokens":[],"total":1.', b"5}"], {"total": 1.5}),
+        ([b'{"a":2e', b"3}"], {"a": 2e3}),
+        ([b'{"a":1', b"2", b"}"], {"a": 12}),
+        ([b'{"a":-', b"1}"], {"a": -1}),
+    ],
+)
+def test_number_split_between_chunks(chunks, expected):
+    assert scan(chunks) == expected
+
+
+def test_truncated_document():
+    with pytest.raises(JsonStreamError):
+        scan([DOCUMENT[:-10]])
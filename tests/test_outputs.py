@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from aggregate_tokens import (
+    aggregate_provider_tokens,
+    list_files,
+    trusted_chain_tokens,
+)
+from coingecko_ids import COINS_LIST_URL
+from http_client import http_client
+from outputs import ALL_TOKENS_FOLDER, TOKENLISTS_FOLDER, chain_filename
+from replay import Fixtures, replay_transport
+from token_list_providers import OneInchTokenLists, TraderJoe
+
+
+def _token(chain_id: int, i: int) -> dict:
+    return {
+        "symbol": f"T{i}",
+        # escapes and non ascii text have to match json.dumps too
+        "name": f'Tökén "{i}"\\ ☃',
+        "address": f"0x{chain_id:08x}{i:032x}",
+        "decimals": 18,
+        "chainId": chain_id,
+        "logoURI": f"https://tokens.example.org/{i}.png" if i % 2 else None,
+    }
+
+
+def _fixtures() -> Fixtures:
+    fixtures = Fixtures()
+
+    def add_json(url: str, body) -> None:
+        fixtures.add(url, 200, "application/json", json.dumps(body).encode())
+
+    add_json(COINS_LIST_URL, [])
+    add_json(
+        TraderJoe.base_url,
+        {"tokens": [_token(c, i) for c in (43114, 56) for i in range(4)]},
+    )
+    for chain_id in OneInchTokenLists.chains:
+        add_json(
+            OneInchTokenLists.base_url.format(chain_id),
+            {str(i): _token(int(chain_id), i) for i in range(2, 6)},
+        )
+    return fixtures
+
+
+async def _provider_data() -> dict:
+    async with http_client(replay_transport(_fixtures()), rate_limits={}) as client:
+        return await TraderJoe.get_tokenlists(
+            client
+        ) | await OneInchTokenLists.get_tokenlists(client)
+
+
+def test_list_files_match_json_dump(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "ignore_list.json").write_text("{}")
+    all_tokens = aggregate_provider_tokens(asyncio.run(_provider_data()), {})
+    trusted = trusted_chain_tokens(all_tokens)
+    assert any(trusted.values())
+    files = list_files(all_tokens, trusted)
+
+    for folder, tokens in (
+        (TOKENLISTS_FOLDER, trusted),
+        (ALL_TOKENS_FOLDER, all_tokens),
+    ):
+        for chain_id, chain_tokens in tokens.items():
+            assert (
+                files[chain_filename(folder, chain_id)]
+                == json.dumps(
+                    [t.dict() for t in chain_tokens], ensure_ascii=False, indent=4
+                ).encode()
+            )
+        assert (
+            files[f"{folder}/all.json"]
+            == json.dumps(
+                {k: [t.dict() for t in v] for k, v in tokens.items()},
+                ensure_ascii=False,
+                indent=4,
+            ).encode()
+        )
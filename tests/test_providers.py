@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+from coingecko_ids import COINS_LIST_URL
+from common import Token
+from http_cache import HttpCache
+from http_client import http_client
+from last_good import LAST_GOOD_MAX_AGE_SECONDS, last_good_store
+from replay import Fixtures, replay_transport
+from token_list_providers import TraderJoe
+
+
+def _token(i: int) -> dict:
+    return {
+        "symbol": f"T{i}",
+        "name": f"Token {i}",
+        "address": f"0x{i:040x}",
+        "decimals": 18,
+        "chainId": 43114,
+    }
+
+
+async def _tokens(
+    body: Optional[bytes],
+    cache: Optional[HttpCache] = None,
+    content_type="application/json",
+) -> list[Token]:
+    # no body is a list that fails to download
+    fixtures = Fixtures()
+    fixtures.add(COINS_LIST_URL, 200, "application/json", b"[]")
+    if body is not None:
+        fixtures.add(TraderJoe.base_url, 200, content_type, body)
+    async with http_client(replay_transport(fixtures), cache, rate_limits={}) as client:
+        data = await TraderJoe.get_tokenlists(client)
+    return [t for tokens in data[TraderJoe.name].values() for t in tokens]
+
+
+def test_invalid_tokens_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = HttpCache()
+    no_address = _token(3)
+    del no_address["address"]
+    tokens = [
+        _token(1),
+        {**_token(2), "decimals": None},
+        no_address,
+        {**_token(4), "address": 4},
+        "not a token",
+        _token(5),
+    ]
+    body = json.dumps({"tokens": tokens}).encode()
+    assert [t.symbol for t in asyncio.run(_tokens(body, cache))] == ["T1", "T5"]
+    # a well formed response stays cached
+    assert cache.fingerprint(TraderJoe.base_url) is not None
+
+
+def test_body_that_is_not_json_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = HttpCache()
+    body = b"<html><body>Service Unavailable</body></html>"
+    assert asyncio.run(_tokens(body, cache, "text/html")) == []
+    assert cache.fingerprint(TraderJoe.base_url) is None
+
+
+def test_failed_list_falls_back_to_stored_tokens(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    body = json.dumps({"tokens": [_token(1), _token(2)]}).encode()
+    assert [t.symbol for t in asyncio.run(_tokens(body))] == ["T1", "T2"]
+    assert [t.symbol for t in asyncio.run(_tokens(None))] == ["T1", "T2"]
+    assert [
+        t.symbol for t in asyncio.run(_tokens(b"<html></html>", None, "text/html"))
+    ] == ["T1", "T2"]
+    stored = TraderJoe.stored_tokenlists()[TraderJoe.name]
+    assert [t.symbol for tokens in stored.values() for t in tokens] == ["T1", "T2"]
+
+
+def test_expired_stored_tokens_are_not_used(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    body = json.dumps({"tokens": [_token(1)]}).encode()
+    asyncio.run(_tokens(body))
+    fetched_at = time.time() - LAST_GOOD_MAX_AGE_SECONDS - 60
+    path = last_good_store.path(TraderJoe.name, TraderJoe.base_url)
+    os.utime(path, (fetched_at, fetched_at))
+    assert asyncio.run(_tokens(None)) == []
+    # rebuilding the lists without fetching takes them however old
+    assert TraderJoe.stored_tokenlists()[TraderJoe.name]
@@ -0,0 +1,20 @@
+import asyncio
+import time
+
+import pytest
+
+from retry import RetryError, RetryScheduler
+
+URL = "https://tokens.example.org/list.json"
+
+
+def test_retry_after_is_not_capped():
+    assert RetryScheduler(base=0.01, cap=1.0).delay(1, 120.0) == 120.0
+
+
+def test_retry_after_past_the_deadline_gives_up():
+    retry = RetryScheduler().start(URL, time.monotonic() + 10)
+    start = time.monotonic()
+    with pytest.raises(RetryError, match="deadline"):
+        asyncio.run(retry.failed("429", retry_after=120.0))
+    assert time.monotonic() - start < 1
@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+import pytest
+
+from coingecko_ids import COINS_LIST_URL
+from http_client import http_client
+from replay import Fixtures, replay_transport
+from shards import shard_of
+from token_list_providers import OneInchTokenLists, TraderJoe
+
+SHARDS = 3
+
+
+def _token(chain_id: int, i: int) -> dict:
+    return {
+        "symbol": f"T{i}",
+        "name": f"Token {i}",
+        "address": f"0x{chain_id:08x}{i:032x}",
+        "decimals": 18,
+        "chainId": chain_id,
+    }
+
+
+def _fixtures() -> Fixtures:
+    fixtures = Fixtures()
+
+    def add_json(url: str, body) -> None:
+        fixtures.add(url, 200, "application/json", json.dumps(body).encode())
+
+    add_json(COINS_LIST_URL, [])
+    # configured for 43114 only, but the list serves many chains
+    add_json(
+        TraderJoe.base_url,
+        {"tokens": [_token(c, i) for c in (43114, 42161, 56, 80094) for i in range(3)]},
+    )
+    for chain_id in OneInchTokenLists.chains:
+        add_json(
+            OneInchTokenLists.base_url.format(chain_id),
+            {str(i): _token(int(chain_id), i) for i in range(3)},
+        )
+    return fixtures
+
+
+async def _tokenlists(provider, chain_filter=None) -> dict[int, set[str]]:
+    async with http_client(replay_transport(_fixtures()), rate_limits={}) as client:
+        data = await provider.get_tokenlists(client, chain_filter=chain_filter)
+    return {
+        int(chain_id): {t.address for t in tokens}
+        for chain_id, tokens in data[provider.name].items()
+    }
+
+
+@pytest.mark.parametrize("provider", [TraderJoe, OneInchTokenLists])
+def test_shards_cover_every_chain_of_a_provider(provider, tmp_path, monkeypatch):
+    # stored tokens of the repo must not stand in for the fixtures
+    monkeypatch.chdir(tmp_path)
+    expected = asyncio.run(_tokenlists(provider))
+    sharded: dict[int, set[str]] = {}
+    for shard in range(SHARDS):
+        sharded |= asyncio.run(
+            _tokenlists(provider, lambda c, shard=shard: shard_of(c, SHARDS) == shard)
+        )
+    assert len(expected) > 1
+    assert sharded == expected
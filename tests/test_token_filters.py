@@ -0,0 +1,50 @@
+import json
+
+from common import Token
+from token_filters import IgnoreList, filter_tokens
+
+
+def _token(chain_id: int, address: str, symbol: str) -> Token:
+    return Token.parse_obj(
+        {
+            "symbol": symbol,
+            "name": symbol,
+            "address": address,
+            "decimals": 18,
+            "chainId": chain_id,
+        }
+    )
+
+
+def test_ignore_list_applies_all_chains_entries(tmp_path):
+    scam = "0x" + "ab" * 20
+    path = tmp_path / "ignore_list.json"
+    path.write_text(
+        json.dumps(
+            {
+                "1": {"addresses": ["0x" + "01" * 20]},
+                "*": {
+                    "addresses": ["0x" + "AB" * 20],
+                    "symbols": ["^FAKE"],
+                },
+            }
+        )
+    )
+    ignore_list = IgnoreList.load(str(path))
+    assert ignore_list.chain_ids is None
+
+    tokens = {
+        chain_id: {
+            t.address: t
+            for t in (
+                _token(chain_id, scam, "SCAM"),
+                _token(chain_id, "0x" + "01" * 20, "ONE"),
+                _token(chain_id, "0x" + "02" * 20, "FAKEUSD"),
+                _token(chain_id, "0x" + "03" * 20, "OK"),
+            )
+        }
+        for chain_id in (1, 56)
+    }
+    filtered = filter_tokens(tokens, [ignore_list])
+    assert [t.symbol for t in filtered[1].values()] == ["OK"]
+    assert [t.symbol for t in filtered[56].values()] == ["ONE", "OK"]
@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+from typing import Iterable, Optional
+
+from common import CHAIN_NAMES_BY_ID, Address, Token, address_key
+from outputs import ALL_TOKENS_FOLDER, TOKENLISTS_FOLDER, chain_filename
+from storage import json_loads
+
+log = logging.getLogger(__name__)
+
+_CHAIN_IDS_BY_NAME = {
+    name: int(chain_id) for chain_id, name in CHAIN_NAMES_BY_ID.items()
+}
+
+
+class ChainTokens:
+    # tokens of one chain file with hash indexes, replaced as a whole on reload
+
+    def __init__(self, tokens: list[Token], stat: tuple[int, int]) -> None:
+        self.tokens = tokens
+        self.stat = stat
+        self.by_address: dict[Address, Token] = {}
+        self.by_symbol: dict[str, list[Token]] = {}
+        self.by_coingecko_id: dict[str, list[Token]] = {}
+        for t in tokens:
+            self.by_address.setdefault(address_key(t.address), t)
+            self.by_symbol.setdefault(t.symbol.lower(), []).append(t)
+            if t.coingeckoId:
+                self.by_coingecko_id.setdefault(t.coingeckoId, []).append(t)
+
+
+def chain_id_from_filename(filename: str) -> Optional[int]:
+    # inverse of outputs.chain_filename, None for all.json and other files
+    name, ext = os.path.splitext(os.path.basename(filename))
+    if ext != ".json":
+        return None
+    if name in _CHAIN_IDS_BY_NAME:
+        return _CHAIN_IDS_BY_NAME[name]
+    try:
+        return int(name)
+    except ValueError:
+        return None
+
+
+def _file_stat(path: str) -> Optional[tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class TokenDB:
+    # read only view of tokenlists/ or all_tokens/ for other services, chains
+    # are loaded on first use and reloaded when their file changes
+
+    def __init__(self, folder: str = TOKENLISTS_FOLDER, auto_reload: bool = True):
+        self.folder = folder
+        self.auto_reload = auto_reload
+        self._chains: dict[int, ChainTokens] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def all_tokens(cls, auto_reload: bool = True) -> "TokenDB":
+        return cls(ALL_TOKENS_FOLDER, auto_reload)
+
+    def chain_ids(self) -> list[int]:
+        chain_ids = []
+        for filename in sorted(os.listdir(self.folder)):
+            chain_id = chain_id_from_filename(filename)
+            if chain_id is not None:
+                chain_ids.append(chain_id)
+        return chain_ids
+
+    def _chain(self, chain_id: int) -> Optional[ChainTokens]:
+        chain = self._chains.get(chain_id)
+        if chain is not None and not self.auto_reload:
+            return chain
+
+        path = chain_filename(self.folder, chain_id)
+        stat = _file_stat(path)
+        if chain is not None and chain.stat == stat:
+            return chain
+        if stat is None:
+            self._chains.pop(chain_id, None)
+            return None
+
+        with self._lock:
+            chain = self._chains.get(chain_id)
+            if chain is not None and chain.stat == stat:
+                return chain
+            with open(path, "rb") as f:
+                raw_tokens = json_loads(f.read())
+            chain = ChainTokens([Token.trusted(**t) for t in raw_tokens], stat)
+            if chain_id in self._chains:
+                log.info(f"{path} changed, reloaded {len(chain.tokens)} tokens")
+            self._chains[chain_id] = chain
+        return chain
+
+    def reload(self) -> None:
+        # drops every loaded chain, they are loaded again on next lookup
+        with self._lock:
+            self._chains.clear()
+
+    def tokens(self, chain_id: int) -> list[Token]:
+        chain = self._chain(chain_id)
+        return list(chain.tokens) if chain is not None else []
+
+    def get(self, chain_id: int, address: str) -> Optional[Token]:
+        chain = self._chain(chain_id)
+        if chain is None:
+            return None
+        return chain.by_address.get(address_key(address))
+
+    def get_many(self, keys: Iterable[tuple[int, str]]) -> list[Optional[Token]]:
+        # every chain file is checked once per call, not once per address
+        keys = list(keys)
+        chains = {chain_id: self._chain(chain_id) for chain_id in {k for k, _ in keys}}
+        res: list[Optional[Token]] = []
+        for chain_id, address in keys:
+            chain = chains[chain_id]
+            res.append(
+                chain.by_address.get(address_key(address))
+                if chain is not None
+                else None
+            )
+        return res
+
+    def _search(self, index: str, key: str, chain_id: Optional[int]) -> list[Token]:
+        chain_ids = [chain_id] if chain_id is not None else self.chain_ids()
+        res = []
+        for i in chain_ids:
+            chain = self._chain(i)
+            if chain is not None:
+                res += getattr(chain, index).get(key, [])
+        return res
+
+    def by_symbol(self, symbol: str, chain_id: Optional[int] = None) -> list[Token]:
+        return self._search("by_symbol", symbol.lower(), chain_id)
+
+    def by_coingecko_id(
+        self, coingecko_id: str, chain_id: Optional[int] = None
+    ) -> list[Token]:
+        return self._search("by_coingecko_id", coingecko_id, chain_id)
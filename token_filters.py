@@ -0,0 +1,118 @@
+import hashlib
+import json
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Optional
+
+from common import Address, Token, address_key
+
+IGNORE_LIST_FILE = "ignore_list.json"
+
+ALL_CHAINS = "*"
+
+
+class TokenFilter(ABC):
+    # chain ids the filter has to see, None for all chains
+    chain_ids: Optional[set[int]] = None
+
+    @abstractmethod
+    def is_ignored(self, chain_id: int, token: Token) -> bool:
+        pass
+
+
+class IgnoreList(TokenFilter):
+    # ignore_list.json: {chain_id or "*": {"addresses": [...], "symbols": [regex]}}
+    # compiled into a lowercase address set and one symbol regex per chain,
+    # "*" entries are checked on every chain
+
+    def __init__(
+        self,
+        addresses: dict[int, set[str]],
+        symbols: dict[int, re.Pattern],
+        all_chains_symbols: Optional[re.Pattern] = None,
+        all_chains_addresses: Optional[set[str]] = None,
+    ) -> None:
+        self.addresses = addresses
+        self.symbols = symbols
+        self.all_chains_symbols = all_chains_symbols
+        self.all_chains_addresses = all_chains_addresses or set()
+        if all_chains_symbols is None and not self.all_chains_addresses:
+            self.chain_ids = set(addresses) | set(symbols)
+
+    @classmethod
+    def load(cls, path: str = IGNORE_LIST_FILE) -> "IgnoreList":
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+
+        def compile_symbols(patterns: list[str]) -> Optional[re.Pattern]:
+            if not patterns:
+                return None
+            return re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+
+        addresses: dict[int, set[str]] = {}
+        symbols: dict[int, re.Pattern] = {}
+        for chain_id, entries in raw.items():
+            if chain_id == ALL_CHAINS:
+                continue
+            if entries.get("addresses"):
+                addresses[int(chain_id)] = {
+                    address_key(a) for a in entries["addresses"]
+                }
+            if pattern := compile_symbols(entries.get("symbols", [])):
+                symbols[int(chain_id)] = pattern
+        all_chains = raw.get(ALL_CHAINS, {})
+        return cls(
+            addresses,
+            symbols,
+            compile_symbols(all_chains.get("symbols", [])),
+            {address_key(a) for a in all_chains.get("addresses", [])},
+        )
+
+    def is_ignored(self, chain_id: int, token: Token) -> bool:
+        addr = address_key(token.address)
+        if (
+            addr in self.addresses.get(chain_id, ())
+            or addr in self.all_chains_addresses
+        ):
+            return True
+        for pattern in (self.symbols.get(chain_id), self.all_chains_symbols):
+            if pattern is not None and pattern.search(token.symbol):
+                return True
+        return False
+
+
+@lru_cache(maxsize=None)
+def load_ignore_list(path: str = IGNORE_LIST_FILE) -> IgnoreList:
+    return IgnoreList.load(path)
+
+
+def filters_fingerprint(paths: tuple[str, ...] = (IGNORE_LIST_FILE,)) -> str:
+    # files the default filters are built from, a change there affects
+    # every chain, whatever the providers serve
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def filter_tokens(
+    tokens: dict[int, dict[Address, Token]],
+    filters: list[TokenFilter],
+) -> dict[int, dict[Address, Token]]:
+    # drops ignored tokens in place, chains no filter cares about are skipped
+    for chain_id, chain_tokens in tokens.items():
+        chain_filters = [
+            f for f in filters if f.chain_ids is None or chain_id in f.chain_ids
+        ]
+        if not chain_filters:
+            continue
+        ignored = [
+            addr
+            for addr, token in chain_tokens.items()
+            if any(f.is_ignored(chain_id, token) for f in chain_filters)
+        ]
+        for addr in ignored:
+            del chain_tokens[addr]
+    return tokens
@@ -1,13 +1,23 @@
 import asyncio
 import json
 import logging.config
+import os
+import time
 from collections import defaultdict
+from typing import Any, Callable, Optional
 
 import httpx
 import yaml
 
 from coingecko_ids import coingecko_ids
-from common import ChainId, Token
+from common import Address, ChainId, normalized_chain_id, Token
+from files import CACHE_FOLDER, write_file_atomic
+from http_client import HttpClient
+from json_stream import JsonPath, JsonStreamError
+from last_good import LAST_GOOD_MAX_AGE_SECONDS, StoredTokens, last_good_store
+from metrics import run_metrics
+from retry import RetryError
+from token_normalizer import token_normalizer
 
 
 with open("./logger.yml", "r") as stream:
@@ -17,6 +27,18 @@ logging.config.dictConfig(config)
 
 log = logging.getLogger(__name__)
 
+COINGECKO_COINS_CACHE_FOLDER = f"{CACHE_FOLDER}/coingecko_coins"
+
+COINGECKO_COINS_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# seconds a provider may spend on retries, later ones are given up and its
+# last stored tokens are used
+PROVIDER_DEADLINE_SECONDS = 10 * 60
+
+# keys under which providers serve their token list when a response is not a
+# plain list, the first one found in a response is used
+TOKEN_LIST_KEYS = ("tokens", "data", "results", "recommendedTokens")
+
 
 class TokenListProvider:
     name: str
@@ -26,76 +48,254 @@ class TokenListProvider:
     _get_chain_id_key = False
     _tokens_to_list = False
     absent_chain_id = False
+    deadline_seconds = PROVIDER_DEADLINE_SECONDS
 
     @classmethod
-    async def get_tokenlists(cls) -> dict[str, dict[ChainId, list[Token]]]:
-        res: dict[ChainId, list[Token]] = defaultdict(list)
+    async def get_tokenlists(
+        cls,
+        client: HttpClient,
+        incremental: bool = False,
+        chain_filter: Optional[Callable[[int], bool]] = None,
+    ) -> dict[str, dict[ChainId, list[Token]]]:
+        deadline = time.monotonic() + cls.deadline_seconds
+        tokens_by_urls = await asyncio.gather(
+            *[
+                cls._get_url_tokens(client, url, chain_ids, incremental, deadline)
+                for url, chain_ids in cls._chain_ids_by_url(chain_filter).items()
+            ]
+        )
+        return {cls.name: cls._tokens_by_chain(tokens_by_urls, chain_filter)}
 
-        for chain_id, chain_name in cls.chains.items():
-            try:
-                resp = await httpx.AsyncClient().get(
-                    cls.base_url.format(chain_id if cls._by_chain_id else chain_name)
-                )
-            except httpx.ReadTimeout:
-                await asyncio.sleep(0.5)
+    @classmethod
+    def stored_tokenlists(
+        cls, chain_filter: Optional[Callable[[int], bool]] = None
+    ) -> dict[str, dict[ChainId, list[Token]]]:
+        # tokens of the last successful download of every url, however old,
+        # rebuilds the lists without fetching anything
+        tokens_by_urls: list[list[Token]] = []
+        for url, chain_ids in cls._chain_ids_by_url(chain_filter).items():
+            run_metrics.url_provider(url, cls.name, chain_ids)
+            stored = cls._last_good_tokens(url)
+            if stored is None:
+                log.warning(f"[{cls.name}] {','.join(chain_ids)} no stored tokens")
+                tokens_by_urls.append([])
                 continue
-            num_retries = 0
-            while resp.status_code != 200:
-                if num_retries > 60:
-                    raise Exception(
-                        f"failed to get tokenlits {cls.base_url} after {num_retries} retries"
-                    )
-                sleep_time = int(resp.headers.get("Retry-After", 1))
-                num_retries += 1
-                log.info(
-                    f"[{cls.name}] {chain_id} {chain_name} waiting {sleep_time} seconds"
-                )
-                await asyncio.sleep(sleep_time)
-                resp = await httpx.AsyncClient().get(
-                    cls.base_url.format(chain_id if cls._by_chain_id else chain_name)
-                )
+            log.info(
+                f"[{cls.name}] {','.join(chain_ids)} using tokens fetched "
+                f"{stored.age_seconds / 3600:.1f} hours ago"
+            )
+            tokens_by_urls.append(stored.tokens())
+        return {cls.name: cls._tokens_by_chain(tokens_by_urls, chain_filter)}
 
-            try:
-                tokenlist = resp.json()
-            except:
-                tokenlist = json.loads(resp.text)
-            if "tokens" in tokenlist:
-                raw_tokens = tokenlist["tokens"]
-            elif "data" in tokenlist:
-                raw_tokens = tokenlist["data"]
-            elif "results" in tokenlist:
-                raw_tokens = tokenlist["results"]
-            elif "recommendedTokens" in tokenlist:
-                raw_tokens = tokenlist["recommendedTokens"]
-            else:
-                raw_tokens = tokenlist
+    @classmethod
+    def _chain_ids_by_url(
+        cls, chain_filter: Optional[Callable[[int], bool]]
+    ) -> dict[str, list[str]]:
+        # single file lists serve many chains, download and parse them once
+        chain_ids_by_url: dict[str, list[str]] = defaultdict(list)
+        for chain_id, chain_name in cls.chains.items():
+            url = cls.base_url.format(chain_id if cls._by_chain_id else chain_name)
+            chain_ids_by_url[url].append(chain_id)
+        if chain_filter is not None:
+            # single file lists may hold tokens of chains missing in
+            # cls.chains, even when only one is configured, so they are
+            # always downloaded
+            chain_ids_by_url = {
+                url: chain_ids
+                for url, chain_ids in chain_ids_by_url.items()
+                if "{}" not in cls.base_url or chain_filter(int(chain_ids[0]))
+            }
+        return chain_ids_by_url
+
+    @classmethod
+    def _tokens_by_chain(
+        cls,
+        tokens_by_urls: list[list[Token]],
+        chain_filter: Optional[Callable[[int], bool]],
+    ) -> dict[ChainId, list[Token]]:
+        res: dict[ChainId, list[Token]] = defaultdict(list)
+        for tokens in tokens_by_urls:
+            for parsed_token in tokens:
+                if chain_filter is None or chain_filter(
+                    normalized_chain_id(parsed_token.chainId)
+                ):
+                    res[parsed_token.chainId].append(parsed_token)
+        return res
+
+    @classmethod
+    def _last_good_tokens(
+        cls,
+        url: str,
+        fingerprint: Optional[str] = None,
+        max_age: Optional[float] = None,
+    ) -> Optional[StoredTokens]:
+        # stored tokens of a different fingerprint are stale, their age is
+        # reported with the run metrics
+        stored = last_good_store.load(cls.name, url, fingerprint, max_age)
+        if stored is not None and fingerprint is None:
+            run_metrics.stale(url, stored.age_seconds)
+        return stored
 
-            if cls._get_chain_id_key and str(chain_id) in raw_tokens:
-                raw_tokens = raw_tokens[str(chain_id)]
+    @classmethod
+    def _descend(cls, path: JsonPath, chain_id: Optional[str]) -> bool:
+        # walks into the token list of a response, tokens are then parsed and
+        # validated one by one while the rest of the body downloads
+        if not path:
+            return True
+        if cls._tokens_to_list:
+            return False
+        if len(path) == 1:
+            return path[0] in TOKEN_LIST_KEYS
+        return (
+            cls._get_chain_id_key
+            and len(path) == 2
+            and path[0] in TOKEN_LIST_KEYS
+            and path[1] == str(chain_id)
+        )
 
-            if cls._tokens_to_list:
-                raw_tokens = list(raw_tokens.values())
+    @classmethod
+    def _is_token_path(cls, path: JsonPath, token_list_key: Optional[str]) -> bool:
+        if cls._tokens_to_list or isinstance(path[0], int):
+            return len(path) == 1
+        return (
+            path[0] == token_list_key
+            and len(path) in (2, 3)
+            and isinstance(path[-1], int)
+        )
 
-            tokens: list[Token] = []
-            for t in raw_tokens:
+    @classmethod
+    def _prepare_token(
+        cls, t: Any, chain_id: Optional[str], ids: dict[str, dict[Address, str]]
+    ) -> Optional[dict]:
+        # cheap checks and lookups of a raw token, validation is then left to
+        # the token normalizer, ids are the loaded coingecko ids
+        if not isinstance(t, dict):
+            log.error(f"Token must be of type dict, got {t=} {cls.__name__}")
+            return None
+        if not t.get("chainId"):
+            if cls.absent_chain_id and chain_id is not None:
+                t["chainId"] = chain_id
+            else:
+                log.error(f"{cls.name} chain id absent")
+                return None
+        if not isinstance(t.get("address"), str):
+            log.error(f"{cls.name} address absent or not a string, got {t=}")
+            return None
+        if not t.get("coingeckoId"):
+            t["coingeckoId"] = ids.get(str(t["chainId"]), {}).get(t["address"].lower())
+        return t
+
+    @classmethod
+    async def _get_url_tokens(
+        cls,
+        client: HttpClient,
+        url: str,
+        chain_ids: list[str],
+        incremental: bool,
+        deadline: float,
+    ) -> list[Token]:
+        run_metrics.url_provider(url, cls.name, chain_ids)
+        try:
+            return await cls._fetch_url_tokens(
+                client, url, chain_ids, incremental, deadline
+            )
+        except (httpx.HTTPError, RetryError, ValueError, OSError) as e:
+            # ValueError is a body that is not the expected json, e.g. an html
+            # page or a truncated list served with 200. Invalid tokens never
+            # get here, the token normalizer skips them
+            if isinstance(e, (ValueError, OSError)):
+                run_metrics.error(url, type(e).__name__)
+            if isinstance(e, JsonStreamError) and client.cache is not None:
+                # a broken cached body would come back with every 304
+                client.cache.forget(url)
+            stored = cls._last_good_tokens(url, max_age=LAST_GOOD_MAX_AGE_SECONDS)
+            if stored is None:
+                log.error(f"[{cls.name}] {','.join(chain_ids)} failed: {str(e)}")
+                return []
+            log.warning(
+                f"[{cls.name}] {','.join(chain_ids)} failed, using tokens fetched "
+                f"{stored.age_seconds / 3600:.1f} hours ago: {str(e)}"
+            )
+            return stored.tokens()
 
-                if not isinstance(t, dict):
-                    log.error(f"Token must be of type dict, got {t=} {cls.__name__}")
+    @classmethod
+    async def _fetch_url_tokens(
+        cls,
+        client: HttpClient,
+        url: str,
+        chain_ids: list[str],
+        incremental: bool,
+        deadline: float,
+    ) -> list[Token]:
+        # tokens of a list shared by several chains must carry their chain id
+        chain_id = chain_ids[0] if len(chain_ids) == 1 else None
+        start = time.perf_counter()
+        # only the synchronous work on raw tokens, waiting for coingecko ids
+        # or the download is not normalize time
+        prepare_seconds = 0.0
+        ids: Optional[dict[str, dict[Address, str]]] = None
+        batcher = token_normalizer.batcher(f"[{cls.name}] {','.join(chain_ids)}")
+        # raw tokens wait for the fingerprint, when the response may turn out
+        # the same as the one of the stored tokens
+        deferred: Optional[list[Any]] = None
+        async with client.stream_json(
+            url, lambda path: cls._descend(path, chain_id), deadline
+        ) as stream:
+            if incremental and stream.fingerprint is not None:
+                stored = cls._last_good_tokens(url, stream.fingerprint)
+                if stored is not None:
+                    return cls._unchanged_tokens(url, chain_ids, stored, start)
+            if incremental and last_good_store.exists(cls.name, url):
+                deferred = []
+
+            # first of TOKEN_LIST_KEYS found in the response
+            token_list_key: Optional[str] = None
+            async for path, t in stream:
+                if token_list_key is None and len(path) > 1:
+                    token_list_key = str(path[0])
+                if not cls._is_token_path(path, token_list_key):
                     continue
-                if not t.get("chainId"):
-                    if cls.absent_chain_id:
-                        t["chainId"] = chain_id
-                    else:
-                        log.error(f"{cls.name} chain id absent")
-                        continue
-                if not t.get("coingeckoId"):
-                    t["coingeckoId"] = coingecko_ids.get(str(t["chainId"]), {}).get(
-                        t["address"].lower()
-                    )
-                parsed_token = Token.parse_obj(t)
-                res[parsed_token.chainId].append(parsed_token)
-            log.info(f"[{cls.name}] {chain_id} {chain_name} OK")
-        return {cls.name: res}
+                if deferred is not None:
+                    deferred.append(t)
+                    continue
+                if ids is None:
+                    ids = await coingecko_ids.load(client)
+                token_start = time.perf_counter()
+                raw_token = cls._prepare_token(t, chain_id, ids)
+                prepare_seconds += time.perf_counter() - token_start
+                if raw_token is not None:
+                    batcher.add(raw_token)
+
+        fingerprint = client.fingerprints.get(url)
+        if deferred is not None:
+            stored = None
+            if fingerprint is not None:
+                stored = cls._last_good_tokens(url, fingerprint)
+            if stored is not None:
+                return cls._unchanged_tokens(url, chain_ids, stored, start)
+            ids = await coingecko_ids.load(client)
+            for t in deferred:
+                token_start = time.perf_counter()
+                raw_token = cls._prepare_token(t, chain_id, ids)
+                prepare_seconds += time.perf_counter() - token_start
+                if raw_token is not None:
+                    batcher.add(raw_token)
+
+        tokens = await batcher.tokens()
+        last_good_store.save(cls.name, url, tokens, fingerprint)
+        run_metrics.normalized(url, len(tokens), prepare_seconds + batcher.seconds)
+        log.info(f"[{cls.name}] {','.join(chain_ids)} OK")
+        return tokens
+
+    @classmethod
+    def _unchanged_tokens(
+        cls, url: str, chain_ids: list[str], stored: StoredTokens, start: float
+    ) -> list[Token]:
+        tokens = stored.tokens()
+        last_good_store.touch(cls.name, url)
+        run_metrics.normalized(url, len(tokens), time.perf_counter() - start)
+        log.info(f"[{cls.name}] {','.join(chain_ids)} unchanged")
+        return tokens
 
 
 class CoinGeckoTokenLists(TokenListProvider):
@@ -131,111 +331,124 @@ class CoinGeckoOrdinalsTokenLists(TokenListProvider):
     base_url = "https://api.coingecko.com/api/v3/coins/list?include_platform=true&x_cg_api_key=CG-Jw3SbMTpURV2M4CZ2b1pvrRS"
     chains = {"-3": "ordinals"}  # Using -3 as chain ID for ordinals
     absent_chain_id = True
+    # every coin is one request to the rate limited coingecko api
+    deadline_seconds = 60 * 60
 
     @classmethod
-    async def get_tokenlists(cls) -> dict[str, dict[ChainId, list[Token]]]:
+    async def get_tokenlists(
+        cls,
+        client: HttpClient,
+        incremental: bool = False,
+        chain_filter: Optional[Callable[[int], bool]] = None,
+    ) -> dict[str, dict[ChainId, list[Token]]]:
         res: dict[ChainId, list[Token]] = defaultdict(list)
+        if chain_filter is not None and not any(
+            map(chain_filter, map(int, cls.chains))
+        ):
+            return {cls.name: res}
 
+        run_metrics.url_provider(cls.base_url, cls.name, list(cls.chains))
+        deadline = time.monotonic() + cls.deadline_seconds
         try:
             # Get list of all tokens
-            num_retries = 0
-            while True:
-                try:
-                    resp = await httpx.AsyncClient().get(f"{cls.base_url}")
-                except httpx.ReadTimeout:
-                    await asyncio.sleep(0.5)
-                    continue
-
-                if resp.status_code == 200:
-                    break
-
-                if num_retries > 60:
-                    raise Exception(
-                        f"failed to get tokenlits {cls.base_url} after {num_retries} retries"
-                    )
-                sleep_time = int(resp.headers.get("Retry-After", 1))
-                num_retries += 1
-                log.info(f"[{cls.name}] waiting {sleep_time} seconds")
-                await asyncio.sleep(sleep_time)
-
-            tokens = resp.json()
+            tokens = await client.get_json(cls.base_url, deadline)
 
             # Filter tokens with ordinals platform
             ordinals_tokens = [
                 t for t in tokens if "platforms" in t and "ordinals" in t["platforms"]
             ]
 
-            # Fetch detailed info for each token
-            for token in ordinals_tokens:
-                log.info(f"[{cls.name}] {token['id']} start")
-                try:
-                    # Get detailed token info
-                    num_retries = 0
-                    while True:
-                        try:
-                            detail_resp = await httpx.AsyncClient().get(
-                                f"https://api.coingecko.com/api/v3/coins/{token['id']}?x_cg_api_key=CG-Jw3SbMTpURV2M4CZ2b1pvrRS"
-                            )
-                        except httpx.ReadTimeout:
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        if detail_resp.status_code == 200:
-                            break
-
-                        if num_retries > 60:
-                            log.error(
-                                f"[{cls.name}] {token['id']} failed after {num_retries} retries"
-                            )
-                            break
-
-                        sleep_time = int(detail_resp.headers.get("Retry-After", 1))
-                        num_retries += 1
-                        log.info(
-                            f"[{cls.name}] {token['id']} waiting {sleep_time} seconds"
-                        )
-                        await asyncio.sleep(sleep_time)
-
-                    if detail_resp.status_code != 200:
-                        log.error(f"[{cls.name}] {token['id']} failed")
-                        continue
-
-                    detail = detail_resp.json()
-
-                    # Create token object
-                    token_data = {
-                        "symbol": token["symbol"],
-                        "name": token["name"],
-                        "address": detail["platforms"]["ordinals"],
-                        "decimals": detail["detail_platforms"]["ordinals"].get(
-                            "decimal_place", 0
-                        )
-                        or 0,
-                        "chainId": "-3",  # Using -3 for ordinals
-                        "logoURI": (
-                            detail["image"]["small"] if "image" in detail else None
-                        ),
-                        "coingeckoId": token["id"],
-                        "listedIn": ["coingecko"],
-                    }
-
-                    parsed_token = Token.parse_obj(token_data)
+            # Fetch detailed info for each token, the rate limiter of the
+            # client keeps them within coingecko api limits
+            details = await asyncio.gather(
+                *[
+                    cls._get_token_data(client, token, deadline)
+                    for token in ordinals_tokens
+                ]
+            )
+            start = time.perf_counter()
+            tokens = [
+                Token.parse_obj(token_data)
+                for token_data in details
+                if token_data is not None
+            ]
+            for parsed_token in tokens:
+                res[parsed_token.chainId].append(parsed_token)
+            run_metrics.normalized(
+                cls.base_url, len(tokens), time.perf_counter() - start
+            )
+            last_good_store.save(cls.name, cls.base_url, tokens)
+
+        except Exception as e:
+            log.error(f"Error in CoinGeckoOrdinalsTokenLists: {str(e)}")
+            res = defaultdict(list)
+            stored = cls._last_good_tokens(
+                cls.base_url, max_age=LAST_GOOD_MAX_AGE_SECONDS
+            )
+            if stored is not None:
+                log.warning(
+                    f"[{cls.name}] using tokens fetched "
+                    f"{stored.age_seconds / 3600:.1f} hours ago"
+                )
+                for parsed_token in stored.tokens():
                     res[parsed_token.chainId].append(parsed_token)
 
-                    log.info(f"[{cls.name}] {token['id']} OK")
+        log.info(f"[{cls.name}] OK")
 
-                    await asyncio.sleep(3)
+        return {cls.name: res}
 
-                except Exception as e:
-                    log.error(f"Error processing token {token['id']}: {str(e)}")
-                    continue
+    @classmethod
+    async def _get_token_data(
+        cls, client: HttpClient, token: dict, deadline: float
+    ) -> Optional[dict]:
+        cache_path = os.path.join(COINGECKO_COINS_CACHE_FOLDER, f"{token['id']}.json")
+        try:
+            if time.time() - os.path.getmtime(cache_path) < COINGECKO_COINS_TTL_SECONDS:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
 
+        log.info(f"[{cls.name}] {token['id']} start")
+        try:
+            # Get detailed token info
+            url = f"https://api.coingecko.com/api/v3/coins/{token['id']}?x_cg_api_key=CG-Jw3SbMTpURV2M4CZ2b1pvrRS"
+            run_metrics.url_provider(url, cls.name, list(cls.chains))
+            detail = (await client.get_with_retries(url, deadline)).json()
+
+            # Create token object
+            token_data = {
+                "symbol": token["symbol"],
+                "name": token["name"],
+                "address": detail["platforms"]["ordinals"],
+                "decimals": detail["detail_platforms"]["ordinals"].get(
+                    "decimal_place", 0
+                )
+                or 0,
+                "chainId": "-3",  # Using -3 for ordinals
+                "logoURI": (detail["image"]["small"] if "image" in detail else None),
+                "coingeckoId": token["id"],
+                "listedIn": ["coingecko"],
+            }
         except Exception as e:
-            log.error(f"Error in CoinGeckoOrdinalsTokenLists: {str(e)}")
+            # expired details are better than none
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    token_data = json.load(f)
+                log.warning(f"[{cls.name}] {token['id']} failed, using cached details")
+                return token_data
+            except (OSError, ValueError):
+                pass
+            log.error(f"Error processing token {token['id']}: {str(e)}")
+            return None
 
-        log.info(f"[{cls.name}] OK")
+        try:
+            write_file_atomic(cache_path, json.dumps(token_data).encode())
+        except OSError as e:
+            log.warning(f"[{cls.name}] {token['id']} details not cached: {str(e)}")
 
-        return {cls.name: res}
+        log.info(f"[{cls.name}] {token['id']} OK")
+        return token_data
 
 
 class UniswapTokenLists(TokenListProvider):
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from typing import Any, Iterator, Optional
+
+from pydantic import ValidationError
+
+from common import Token, address_cache
+
+log = logging.getLogger(__name__)
+
+# raw tokens sent to a worker at once, large enough that pickling them is
+# cheap next to validating them
+NORMALIZE_BATCH_SIZE = 1000
+
+# (symbol, name, address, decimals, chainId, logoURI, coingeckoId, listedIn)
+TokenRecord = tuple[Any, ...]
+
+
+def token_record(token: Token) -> TokenRecord:
+    # plain tuples pickle much smaller and faster than pydantic models,
+    # Token.trusted(*record) turns them back into tokens
+    return (
+        token.symbol,
+        token.name,
+        token.address,
+        token.decimals,
+        token.chainId,
+        token.logoURI,
+        token.coingeckoId,
+        token.listedIn,
+    )
+
+
+def invalid_token_error(raw_token: dict, e: ValidationError) -> str:
+    fields = ", ".join(".".join(map(str, err["loc"])) for err in e.errors())
+    return f"invalid {fields} of {raw_token.get('symbol')} {raw_token.get('address')}"
+
+
+def normalize_batch(
+    raw_tokens: list[dict],
+) -> tuple[list[TokenRecord], list[str], float]:
+    # runs in a worker, validated tokens are sent back as records and invalid
+    # ones as errors, logged by the parent
+    start = time.perf_counter()
+    records = []
+    errors = []
+    for t in raw_tokens:
+        try:
+            records.append(token_record(Token.parse_obj(t)))
+        except ValidationError as e:
+            errors.append(invalid_token_error(t, e))
+    return records, errors, time.perf_counter() - start
+
+
+class TokenBatcher:
+    # validates raw tokens of one provider url, right away when there is no
+    # pool, otherwise in batches on the pool while the download goes on.
+    # Invalid tokens are logged and skipped, name prefixes their errors
+
+    def __init__(self, pool: Optional[ProcessPoolExecutor], name: str) -> None:
+        self._pool = pool
+        self._name = name
+        self._tokens: list[Token] = []
+        self._batch: list[dict] = []
+        self._futures: list[asyncio.Future] = []
+        # seconds spent validating, in this process or in the workers
+        self.seconds = 0.0
+
+    def add(self, raw_token: dict) -> None:
+        if self._pool is None:
+            start = time.perf_counter()
+            try:
+                self._tokens.append(Token.parse_obj(raw_token))
+            except ValidationError as e:
+                self._invalid(invalid_token_error(raw_token, e))
+            self.seconds += time.perf_counter() - start
+            return
+        self._batch.append(raw_token)
+        if len(self._batch) >= NORMALIZE_BATCH_SIZE:
+            self._submit()
+
+    def _submit(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._futures.append(
+            loop.run_in_executor(self._pool, normalize_batch, self._batch)
+        )
+        self._batch = []
+
+    def _invalid(self, error: str) -> None:
+        log.error(f"{self._name} skipped token: {error}")
+
+    async def tokens(self) -> list[Token]:
+        if self._batch:
+            self._submit()
+        # batches are gathered in order, so tokens keep the order of the list
+        for records, errors, seconds in await asyncio.gather(*self._futures):
+            self.seconds += seconds
+            for error in errors:
+                self._invalid(error)
+            for record in records:
+                # workers already checksummed the address, so merging does
+                # not compute it again
+                address_cache.add(record[2])
+                self._tokens.append(Token.trusted(*record))
+        self._futures = []
+        return self._tokens
+
+
+class TokenNormalizer:
+    # process pool shared by all providers of a run, validation and address
+    # checksums are cpu bound and would otherwise stall every download
+    # sharing the event loop
+
+    def __init__(self) -> None:
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @contextmanager
+    def running(self, workers: int) -> Iterator[None]:
+        # with one worker tokens are validated in this process, as before
+        if workers <= 1:
+            yield
+            return
+        # spawned workers do not inherit the threads of the event loop
+        self._pool = ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
+        try:
+            yield
+        finally:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def batcher(self, name: str) -> TokenBatcher:
+        return TokenBatcher(self._pool, name)
+
+
+token_normalizer = TokenNormalizer()